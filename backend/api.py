@@ -1,28 +1,51 @@
 """FastAPI backend for Course Learning Agent."""
 import os
+import time
+import uuid
+import asyncio
+import atexit
 import logging
-import shutil
-from typing import List, Optional
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import StreamingResponse
+import logging.handlers
+import queue
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable, List, Optional
+import aiofiles
+import aiofiles.os
+import orjson
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from datetime import datetime
 
-# 配置日志，显示工具调用详情
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(name)s] %(levelname)s: %(message)s",
-    datefmt="%H:%M:%S"
-)
+# 配置日志，显示工具调用详情。
+# 业务代码只把日志记录放进队列（QueueHandler），由后台 QueueListener 线程写 stderr，
+# 事件循环和 SSE 流不会因终端 I/O 阻塞。
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter(
+    "%(asctime)s [%(name)s] %(levelname)s: %(message)s", datefmt="%H:%M:%S"
+))
+_log_enqueue = logging.handlers.QueueHandler(_log_queue)
+_log_enqueue.setFormatter(logging.Formatter())  # 只格式化 message + 异常栈，前缀由输出端添加
+logging.basicConfig(level=logging.INFO, handlers=[_log_enqueue])
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_output)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+logger = logging.getLogger(__name__)
 
 from backend.schemas import (
-    CourseWorkspace, ChatRequest, ChatResponse, ChatMessage
+    CourseWorkspace, ChatRequest, ChatResponse, ChatMessage, IndexJob
 )
-from rag.ingest import DocumentParser
-from rag.chunk import chunk_documents
-from rag.store_faiss import build_index
-from core.orchestration.runner import OrchestrationRunner
+from backend.registry import WorkspaceRegistry
+from rag.ingest import parse_and_chunk_document
+from rag.store_faiss import FAISSStore, IndexBuilder, file_hash
+from core.orchestration.runner import OrchestrationRunner, flush_pending_writes
+from core.llm.openai_compat import close_llm_client, warmup_llm_client
 
 app = FastAPI(title="Course Learning Agent API")
 
@@ -35,28 +58,62 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 上传大小上限（字节），默认 200MB
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(200 * 1024 * 1024)))
+
+
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    """在读取请求体之前按 Content-Length 拒绝超大上传，避免先把整个文件收进来。"""
+    if request.method == "POST" and request.url.path.endswith("/upload"):
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES:
+            return JSONResponse(
+                status_code=413,
+                content={"detail": f"文件过大，上限 {MAX_UPLOAD_BYTES // (1024 * 1024)}MB"},
+            )
+    return await call_next(request)
+
+
 # Global runner
 runner = OrchestrationRunner()
 
-# In-memory workspace registry (in production, use database)
-workspaces = {}
+# Workspace registry（SQLite 持久化，多 worker 共享）
+workspaces = WorkspaceRegistry(data_dir=runner.data_dir)
+
+
+def _scan_files(directory: str) -> List[os.DirEntry]:
+    """列出目录下的普通文件（按文件名排序），目录不存在时返回空列表。
+
+    os.scandir 的 DirEntry 缓存了 readdir 返回的类型信息，省去逐个 isfile 的系统调用。
+    上传中的临时文件（*.part）不计入。
+    """
+    try:
+        with os.scandir(directory) as it:
+            return sorted(
+                (e for e in it if e.is_file() and not e.name.endswith(".part")),
+                key=lambda e: e.name,
+            )
+    except FileNotFoundError:
+        return []
 
 
 def load_workspaces_from_disk():
-    """启动时从磁盘扫描已有 workspace 目录恢复数据。"""
+    """启动时把磁盘上尚未登记的 workspace 目录导入 registry。
+
+    只列出 data_dir 顶层目录；已登记的课程不再扫描 uploads/，启动开销与文件数量无关。
+    """
     data_dir = os.path.abspath(runner.data_dir)
     if not os.path.exists(data_dir):
         return
-    for course_name in os.listdir(data_dir):
-        course_path = os.path.join(data_dir, course_name)
-        if not os.path.isdir(course_path):
-            continue
-        uploads_dir = os.path.join(course_path, "uploads")
-        documents = []
-        if os.path.exists(uploads_dir):
-            documents = [f for f in os.listdir(uploads_dir)
-                         if os.path.isfile(os.path.join(uploads_dir, f))]
-        workspaces[course_name] = CourseWorkspace(
+    known = set(workspaces.course_names())
+    with os.scandir(data_dir) as it:
+        course_dirs = [e for e in it if e.name not in known and e.is_dir()]
+    for entry in course_dirs:
+        course_name = entry.name
+        course_path = entry.path
+        documents = [e.name for e in _scan_files(os.path.join(course_path, "uploads"))]
+        workspaces.create(CourseWorkspace(
             course_name=course_name,
             subject="",
             created_at=datetime.now(),
@@ -65,7 +122,7 @@ def load_workspaces_from_disk():
             notes_path=os.path.join(course_path, "notes"),
             mistakes_path=os.path.join(course_path, "mistakes"),
             exams_path=os.path.join(course_path, "exams"),
-        )
+        ))
         # 确保所有子目录存在
         for subdir in ["uploads", "index", "notes", "mistakes", "exams", "practices"]:
             os.makedirs(os.path.join(course_path, subdir), exist_ok=True)
@@ -75,6 +132,129 @@ def load_workspaces_from_disk():
 load_workspaces_from_disk()
 
 
+@dataclass(frozen=True)
+class WorkspacePaths:
+    """某课程 workspace 下常用的绝对路径。"""
+    root: str
+    uploads: str
+    index: str        # FAISS 索引前缀（不含扩展名）
+    index_faiss: str
+    index_pkl: str
+
+
+@lru_cache(maxsize=256)
+def _ws_paths(course_name: str) -> WorkspacePaths:
+    """缓存 workspace 路径计算（纯字符串运算，与磁盘状态无关，无需失效）。"""
+    root = os.path.abspath(runner.get_workspace_path(course_name))
+    index = os.path.join(root, "index", "faiss_index")
+    return WorkspacePaths(
+        root=root,
+        uploads=os.path.join(root, "uploads"),
+        index=index,
+        index_faiss=f"{index}.faiss",
+        index_pkl=f"{index}.pkl",
+    )
+
+
+def _mtime_or_none(path: str) -> Optional[float]:
+    """单次 os.stat 同时完成存在性检查与取 mtime。"""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+# 上传时每次读写的块大小
+_UPLOAD_CHUNK_SIZE = 1 << 20
+
+# 各二进制格式的文件头（magic bytes）；txt/md 为纯文本，无固定文件头
+_MAGIC_BYTES = {
+    ".pdf": (b"%PDF",),
+    ".docx": (b"PK\x03\x04",),
+    ".pptx": (b"PK\x03\x04",),
+    ".ppt": (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1",),  # OLE2 复合文档
+}
+
+
+# 文档解析（PDF/DOCX/PPTX）与切块是 CPU 密集型且各文件互相独立，按文件放到进程池并行执行，
+# 避免阻塞事件循环。进程数由 INGEST_N_THREADS 控制，默认等于 CPU 核数。
+_parse_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _parse_workers() -> int:
+    return int(os.getenv("INGEST_N_THREADS", "0")) or os.cpu_count() or 1
+
+
+def _get_parse_pool() -> ProcessPoolExecutor:
+    """懒加载文档解析进程池。"""
+    global _parse_pool
+    if _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(max_workers=_parse_workers())
+    return _parse_pool
+
+
+async def _parse_and_chunk_documents(
+    paths: List[str],
+    on_progress: Optional[Callable[[], None]] = None,
+    out_queue: Optional[asyncio.Queue] = None,
+) -> tuple[list, List[str]]:
+    """在进程池中按文件并行解析 + 切块，返回 (chunks, failed)。单个文件出错不影响其他文件。
+
+    结果按 paths 顺序拼接，与串行 chunk_documents(所有页面) 的输出一致。
+
+    on_progress: 每解析完一个文件回调一次（用于更新后台任务进度）。
+    out_queue: 若给出，每个文件切块完成后立即把其 chunks 放入队列（供下游向量化流水线消费）。
+    """
+    loop = asyncio.get_running_loop()
+    pool = _get_parse_pool()
+
+    async def _parse_one(path: str):
+        try:
+            chunks = await loop.run_in_executor(pool, parse_and_chunk_document, path)
+        except Exception as e:
+            return e
+        finally:
+            if on_progress:
+                on_progress()
+        if out_queue is not None and chunks:
+            await out_queue.put(chunks)
+        return chunks
+
+    results = await asyncio.gather(*(_parse_one(p) for p in paths))
+    all_chunks, failed = [], []
+    for path, chunks in zip(paths, results):
+        doc_name = os.path.basename(path)
+        if isinstance(chunks, BaseException):
+            logger.warning("[Index] 解析 %s 失败: %s", doc_name, chunks)
+            failed.append(doc_name)
+        elif chunks:
+            all_chunks.extend(chunks)
+        else:
+            failed.append(doc_name)
+    return all_chunks, failed
+
+
+@app.on_event("startup")
+def _warmup_llm_client():
+    warmup_llm_client()
+
+
+@app.on_event("shutdown")
+def _shutdown_parse_pool():
+    if _parse_pool is not None:
+        _parse_pool.shutdown(wait=False, cancel_futures=True)
+
+
+@app.on_event("shutdown")
+def _shutdown_llm_client():
+    close_llm_client()
+
+
+@app.on_event("shutdown")
+def _flush_record_writes():
+    flush_pending_writes(timeout=10)
+
+
 class CreateWorkspaceRequest(BaseModel):
     course_name: str
     subject: str
@@ -118,22 +298,24 @@ async def create_workspace(request: CreateWorkspaceRequest):
         exams_path=os.path.join(workspace_path, "exams")
     )
     
-    workspaces[request.course_name] = workspace
+    if not workspaces.create(workspace):
+        raise HTTPException(status_code=400, detail="Workspace already exists")
     return workspace
 
 
 @app.get("/workspaces", response_model=List[CourseWorkspace])
 async def list_workspaces():
     """List all workspaces."""
-    return list(workspaces.values())
+    return workspaces.list_all()
 
 
 @app.get("/workspaces/{course_name}", response_model=CourseWorkspace)
 async def get_workspace(course_name: str):
     """Get a specific workspace."""
-    if course_name not in workspaces:
+    workspace = workspaces.get(course_name)
+    if workspace is None:
         raise HTTPException(status_code=404, detail="Workspace not found")
-    return workspaces[course_name]
+    return workspace
 
 
 @app.post("/workspaces/{course_name}/upload")
@@ -144,9 +326,8 @@ async def upload_document(
     """Upload a document to workspace."""
     if course_name not in workspaces:
         raise HTTPException(status_code=404, detail="Workspace not found")
-    
-    workspace = workspaces[course_name]
-    workspace_path = runner.get_workspace_path(course_name)
+
+    paths = _ws_paths(course_name)
 
     # 安全校验：只取文件名部分，防止路径穿越
     safe_filename = os.path.basename(file.filename or "")
@@ -159,16 +340,40 @@ async def upload_document(
     if ext not in allowed_exts:
         raise HTTPException(status_code=400, detail=f"不支持的文件类型: {ext}，仅支持 pdf/txt/md/docx/pptx/ppt")
 
-    upload_path = os.path.join(workspace_path, "uploads", safe_filename)
-
-    # Save file
-    with open(upload_path, "wb") as f:
-        content = await file.read()
-        f.write(content)
+    # 格式嗅探：只读文件头 8 字节，与扩展名不符的直接拒绝
+    magics = _MAGIC_BYTES.get(ext)
+    if magics:
+        head = await file.read(8)
+        if not head.startswith(magics):
+            raise HTTPException(status_code=400, detail=f"文件内容与扩展名 {ext} 不符")
+        await file.seek(0)
+
+    upload_path = os.path.join(paths.uploads, safe_filename)
+
+    # Save file：按 1MB 分块异步写盘，内存占用与文件大小无关，也不阻塞事件循环。
+    # 无 Content-Length（分块传输）时，边写边计数兜底。
+    # 先写到唯一的临时文件再原子 rename，同名文件并发上传不会互相写花，构建索引也不会读到半个文件
+    tmp_path = f"{upload_path}.{uuid.uuid4().hex}.part"
+    written = 0
+    try:
+        async with aiofiles.open(tmp_path, "wb") as f:
+            while chunk := await file.read(_UPLOAD_CHUNK_SIZE):
+                written += len(chunk)
+                if written > MAX_UPLOAD_BYTES:
+                    raise HTTPException(
+                        status_code=413, detail=f"文件过大，上限 {MAX_UPLOAD_BYTES // (1024 * 1024)}MB"
+                    )
+                await f.write(chunk)
+        await aiofiles.os.replace(tmp_path, upload_path)
+    except BaseException:
+        try:
+            await aiofiles.os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
     
     # Add to workspace documents
-    if safe_filename not in workspace.documents:
-        workspace.documents.append(safe_filename)
+    workspaces.add_document(course_name, safe_filename)
     
     return {
         "message": f"File {safe_filename} uploaded successfully",
@@ -181,52 +386,52 @@ async def list_workspace_files(course_name: str):
     """列出课程的已上传文件及索引状态。"""
     if course_name not in workspaces:
         raise HTTPException(status_code=404, detail="Workspace not found")
-    workspace_path = runner.get_workspace_path(course_name)
-    uploads_dir = os.path.join(workspace_path, "uploads")
-    index_path = os.path.abspath(workspaces[course_name].index_path)
+    paths = _ws_paths(course_name)
 
     files = []
-    if os.path.exists(uploads_dir):
-        for fname in sorted(os.listdir(uploads_dir)):
-            fpath = os.path.join(uploads_dir, fname)
-            if os.path.isfile(fpath):
-                stat = os.stat(fpath)
-                files.append({
-                    "name": fname,
-                    "size": stat.st_size,
-                    "modified": datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M"),
-                })
+    for entry in _scan_files(paths.uploads):
+        stat = entry.stat()
+        files.append({
+            "name": entry.name,
+            "size": stat.st_size,
+            "modified": datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M"),
+        })
 
     # 索引状态：FAISS 实际存储为 faiss_index.faiss + faiss_index.pkl 两个平文件
-    index_built = os.path.exists(f"{index_path}.faiss")
+    faiss_mtime = _mtime_or_none(paths.index_faiss)
+    index_built = faiss_mtime is not None
     index_mtime = None
     if index_built:
-        try:
-            mtimes = [os.stat(f).st_mtime for f in [f"{index_path}.faiss", f"{index_path}.pkl"]
-                      if os.path.exists(f)]
-            if mtimes:
-                index_mtime = datetime.fromtimestamp(max(mtimes)).strftime("%Y-%m-%d %H:%M")
-        except Exception:
-            pass
+        mtimes = [m for m in (faiss_mtime, _mtime_or_none(paths.index_pkl)) if m is not None]
+        index_mtime = datetime.fromtimestamp(max(mtimes)).strftime("%Y-%m-%d %H:%M")
 
     return {"files": files, "index_built": index_built, "index_mtime": index_mtime}
 
 
+@app.get("/workspaces/{course_name}/files/{filename}")
+async def download_workspace_file(course_name: str, filename: str):
+    """下载课程中某个已上传的原始文件（FileResponse 走 sendfile，零拷贝）。"""
+    if course_name not in workspaces:
+        raise HTTPException(status_code=404, detail="Workspace not found")
+    safe_filename = os.path.basename(filename)
+    fpath = os.path.join(_ws_paths(course_name).uploads, safe_filename)
+    if not await aiofiles.os.path.isfile(fpath):
+        raise HTTPException(status_code=404, detail=f"文件 {safe_filename} 不存在")
+    return FileResponse(fpath, filename=safe_filename)
+
+
 @app.delete("/workspaces/{course_name}/files/{filename}")
 async def delete_workspace_file(course_name: str, filename: str):
     """删除课程中某个已上传的原始文件。"""
     if course_name not in workspaces:
         raise HTTPException(status_code=404, detail="Workspace not found")
     safe_filename = os.path.basename(filename)
-    workspace_path = runner.get_workspace_path(course_name)
-    fpath = os.path.join(workspace_path, "uploads", safe_filename)
-    if not os.path.isfile(fpath):
+    fpath = os.path.join(_ws_paths(course_name).uploads, safe_filename)
+    if not await aiofiles.os.path.isfile(fpath):
         raise HTTPException(status_code=404, detail=f"文件 {safe_filename} 不存在")
-    os.remove(fpath)
-    # 同步内存
-    ws = workspaces[course_name]
-    if safe_filename in ws.documents:
-        ws.documents.remove(safe_filename)
+    await aiofiles.os.remove(fpath)
+    # 同步 registry
+    workspaces.remove_document(course_name, safe_filename)
     return {"message": f"文件 {safe_filename} 已删除"}
 
 
@@ -235,82 +440,193 @@ async def delete_workspace_index(course_name: str):
     """删除课程的 FAISS 索引（不影响已上传的原始文件）。"""
     if course_name not in workspaces:
         raise HTTPException(status_code=404, detail="Workspace not found")
-    index_path = os.path.abspath(workspaces[course_name].index_path)
-    faiss_file = f"{index_path}.faiss"
-    pkl_file = f"{index_path}.pkl"
-    if not os.path.exists(faiss_file):
+    paths = _ws_paths(course_name)
+    try:
+        os.remove(paths.index_faiss)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="索引不存在")
-    for f in [faiss_file, pkl_file]:
-        if os.path.exists(f):
+    for f in (paths.index_pkl, f"{paths.index}.hashes.pkl", f"{paths.index}.manifest.json"):
+        try:
             os.remove(f)
+        except FileNotFoundError:
+            pass
     return {"message": "索引已删除"}
 
 
-@app.post("/workspaces/{course_name}/build-index")
-async def build_workspace_index(course_name: str):
-    """Build RAG index for workspace."""
-    if course_name not in workspaces:
-        raise HTTPException(status_code=404, detail="Workspace not found")
-    
-    workspace = workspaces[course_name]
-    workspace_path = runner.get_workspace_path(course_name)
-    uploads_dir = os.path.join(workspace_path, "uploads")
+# 后台索引构建任务（进程内保存；仅保留任务状态，不持久化）
+index_jobs: dict[str, IndexJob] = {}
+# 已结束的任务保留多久（秒）；每门课程最近一次任务始终保留，供 index-status 查询
+INDEX_JOB_TTL = int(os.getenv("INDEX_JOB_TTL", "3600"))
+# 持有 task 引用，防止事件循环只保留弱引用导致任务被 GC
+_background_tasks: set = set()
+
+
+def _prune_index_jobs():
+    """清理结束超过 INDEX_JOB_TTL 的任务，避免 index_jobs 随进程运行无限增长。"""
+    latest = {}
+    for job in index_jobs.values():
+        if job.created_at > latest.get(job.course_name, datetime.min):
+            latest[job.course_name] = job.created_at
+    now = datetime.now()
+    for job_id, job in list(index_jobs.items()):
+        if (job.finished_at is not None
+                and (now - job.finished_at).total_seconds() > INDEX_JOB_TTL
+                and job.created_at != latest[job.course_name]):
+            del index_jobs[job_id]
+
+
+async def _run_index_job(job: IndexJob, uploads_dir: str, disk_files: List[str], index_path: str):
+    """后台执行 解析/切块 → 向量化 → 写盘，进度与错误写回 job，不向外抛异常。
+
+    解析与向量化通过有界 asyncio.Queue 流水线重叠：每个文件切块完成即送去向量化，
+    无需等全部文件解析完。
+    """
+    job.status = "running"
+    started = time.monotonic()
+
+    skipped = 0  # 内容未变、无需重新解析的文件数（不计入速率）
+
+    def _on_progress():
+        job.processed += 1
+        elapsed = time.monotonic() - started
+        rate = (job.processed - skipped) / elapsed if elapsed > 0 else 0.0
+        job.eta = (job.total - job.processed) / rate if rate > 0 else None
+        logger.info("[Index] %s: %d/%d 文件 @ %.1f 文件/分钟", job.course_name, job.processed, job.total, rate * 60)
 
     try:
-        # 直接扫描 uploads/ 目录，避免内存列表与磁盘不同步导致漏文件
-        allowed_exts = {".pdf", ".txt", ".md", ".docx", ".pptx", ".ppt"}
-        disk_files = []
-        if os.path.exists(uploads_dir):
-            disk_files = [
-                f for f in os.listdir(uploads_dir)
-                if os.path.isfile(os.path.join(uploads_dir, f))
-                and os.path.splitext(f)[1].lower() in allowed_exts
-            ]
-        # 回写内存，保持一致
-        workspace.documents = disk_files
-
-        if not disk_files:
-            raise HTTPException(status_code=400, detail="uploads/ 目录中没有可用文件，请先上传教材")
-
-        # Parse all documents
-        all_pages = []
-        failed = []
-        for doc_name in disk_files:
-            doc_path = os.path.join(uploads_dir, doc_name)
-            pages = DocumentParser.parse_document(doc_path)
-            if pages:
-                all_pages.extend(pages)
-            else:
-                failed.append(doc_name)
-
-        if not all_pages:
+        # 增量构建：加载旧索引，内容未变的文件直接复用其 chunk 与向量，跳过解析和向量化
+        previous = None
+        if os.path.exists(f"{index_path}.faiss"):
+            try:
+                previous = FAISSStore()
+                await asyncio.to_thread(previous.load, index_path)
+            except Exception as e:
+                logger.warning("[Index] 旧索引加载失败，将全量重建: %s", e)
+                previous = None
+
+        hashes = await asyncio.to_thread(
+            lambda: {f: file_hash(os.path.join(uploads_dir, f)) for f in disk_files}
+        )
+        unchanged = set()
+        if previous is not None:
+            unchanged = {f for f in disk_files if previous.file_hashes.get(f) == hashes[f]}
+        reused_chunks = [c for c in previous.chunks if c["doc_id"] in unchanged] if previous else []
+        to_parse = [f for f in disk_files if f not in unchanged]
+        skipped = job.processed = len(unchanged)
+
+        builder = IndexBuilder(previous)
+        chunk_q: asyncio.Queue = asyncio.Queue(maxsize=2 * _parse_workers())
+
+        async def _embed_stage():
+            # 向量化在线程中执行；feed 与 embed_pending 只在本协程中串行调用
+            while (chunks := await chunk_q.get()) is not None:
+                builder.feed(chunks)
+                await asyncio.to_thread(builder.embed_pending)
+
+        embedder = asyncio.create_task(_embed_stage())
+        # Parse + chunk changed documents（进程池按文件并行，边解析边向量化）
+        parser = asyncio.create_task(_parse_and_chunk_documents(
+            [os.path.join(uploads_dir, doc_name) for doc_name in to_parse],
+            on_progress=_on_progress,
+            out_queue=chunk_q,
+        ))
+        sentinel = None
+        try:
+            # 向量化出错时解析 worker 会永远阻塞在已满的队列上，因此与 embedder 竞争等待；
+            # 收到 None 之前 embedder 只会因异常结束
+            await asyncio.wait({parser, embedder}, return_when=asyncio.FIRST_COMPLETED)
+            if embedder.done():
+                embedder.result()
+            new_chunks, failed = parser.result()
+            sentinel = asyncio.create_task(chunk_q.put(None))
+            await asyncio.wait({sentinel, embedder}, return_when=asyncio.FIRST_COMPLETED)
+            await embedder
+        finally:
+            pending = [t for t in (parser, embedder, sentinel) if t is not None and not t.done()]
+            for t in pending:
+                t.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        if not new_chunks and not reused_chunks:
             detail = "所有文件解析均未提取到文本。"
             if failed:
                 detail += f" 解析失败的文件：{', '.join(failed)}（PDF 请确认非扫描版；PPTX 请确认文件未损坏）"
-            raise HTTPException(status_code=400, detail=detail)
+            job.status = "failed"
+            job.error = detail
+            return
+
+        # 向量化 / 写盘都是同步阻塞调用，放到线程中执行
+        chunks = reused_chunks + new_chunks
+        store = await asyncio.to_thread(builder.build, chunks)
+        # 解析失败的文件不记录哈希，下次构建时重试
+        store.file_hashes = {f: hashes[f] for f in disk_files if f not in failed}
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        await asyncio.to_thread(store.save, index_path)
 
-        # Chunk documents
-        chunks = chunk_documents(all_pages)
+        job.num_chunks = len(chunks)
+        job.num_documents = len(disk_files)
+        job.eta = 0.0
+        job.status = "done"
+    except Exception as e:
+        logger.warning("[Index] %s 构建索引失败", job.course_name, exc_info=True)
+        job.status = "failed"
+        job.error = f"构建索引时发生错误: {str(e)}"
+        job.traceback = traceback.format_exc()
+    finally:
+        job.finished_at = datetime.now()
 
-        # Build index
-        store = build_index(chunks)
 
-        # Save index
-        index_path = os.path.abspath(workspace.index_path)
-        os.makedirs(os.path.dirname(index_path), exist_ok=True)
-        store.save(index_path)
-
-        return {
-            "message": "Index built successfully",
-            "num_chunks": len(chunks),
-            "num_documents": len(workspace.documents)
-        }
-    except HTTPException:
-        raise
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"构建索引时发生错误: {str(e)}")
+@app.post("/workspaces/{course_name}/build-index", status_code=202)
+async def build_workspace_index(course_name: str):
+    """提交后台索引构建任务，立即返回 job_id，通过 jobs/{job_id} 轮询进度。"""
+    if course_name not in workspaces:
+        raise HTTPException(status_code=404, detail="Workspace not found")
+
+    # 同一课程已有进行中的任务时直接返回该任务，避免重复构建
+    for job in index_jobs.values():
+        if job.course_name == course_name and job.status in ("queued", "running"):
+            return {"job_id": job.job_id, "status": job.status}
+
+    paths = _ws_paths(course_name)
+    uploads_dir = paths.uploads
+
+    # 直接扫描 uploads/ 目录，避免内存列表与磁盘不同步导致漏文件
+    allowed_exts = {".pdf", ".txt", ".md", ".docx", ".pptx", ".ppt"}
+    disk_files = [
+        e.name for e in _scan_files(uploads_dir)
+        if os.path.splitext(e.name)[1].lower() in allowed_exts
+    ]
+    # 回写 registry，保持一致
+    workspaces.set_documents(course_name, disk_files)
+
+    if not disk_files:
+        raise HTTPException(status_code=400, detail="uploads/ 目录中没有可用文件，请先上传教材")
+
+    _prune_index_jobs()
+    job = IndexJob(job_id=uuid.uuid4().hex, course_name=course_name, total=len(disk_files))
+    index_jobs[job.job_id] = job
+    task = asyncio.create_task(_run_index_job(job, uploads_dir, disk_files, paths.index))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return {"job_id": job.job_id, "status": job.status}
+
+
+@app.get("/workspaces/{course_name}/jobs/{job_id}", response_model=IndexJob)
+async def get_index_job(course_name: str, job_id: str):
+    """查询后台索引构建任务状态。"""
+    job = index_jobs.get(job_id)
+    if job is None or job.course_name != course_name:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/workspaces/{course_name}/index-status", response_model=IndexJob)
+async def get_index_status(course_name: str):
+    """返回该课程最近一次索引构建任务的状态。"""
+    jobs = [j for j in index_jobs.values() if j.course_name == course_name]
+    if not jobs:
+        raise HTTPException(status_code=404, detail="该课程暂无索引构建任务")
+    return max(jobs, key=lambda j: j.created_at)
 
 
 @app.post("/chat", response_model=ChatResponse)
@@ -325,7 +641,7 @@ async def chat(request: ChatRequest):
         mode=request.mode,
         user_message=request.message,
         state={},
-        history=[m.model_dump() for m in request.history] if request.history else []
+        history=request.history_dicts()
     )
     
     return ChatResponse(
@@ -337,11 +653,10 @@ async def chat(request: ChatRequest):
 @app.post("/chat/stream")
 async def chat_stream(request: ChatRequest):
     """流式聊天接口，SSE 格式逐 token 输出。chunk 用 JSON 编码防止换行符破坏 SSE 协议。"""
-    import json as _json
     if request.course_name not in workspaces:
         raise HTTPException(status_code=404, detail="Workspace not found")
 
-    history = [m.model_dump() for m in request.history] if request.history else []
+    history = request.history_dicts()
 
     def event_generator():
         try:
@@ -354,13 +669,13 @@ async def chat_stream(request: ChatRequest):
             ):
                 if chunk:
                     # 用 JSON 序列化 chunk，换行符等特殊字符会被转义，不会破坏 SSE 行格式
-                    yield f"data: {_json.dumps(chunk, ensure_ascii=False)}\n\n"
+                    # orjson 直接输出 UTF-8 bytes，省去逐 token 的 str 编码
+                    yield b"data: " + orjson.dumps(chunk) + b"\n\n"
         except Exception as e:
-            import traceback
-            traceback.print_exc()
-            yield f"data: {_json.dumps(f'（生成回答时出错：{e}）', ensure_ascii=False)}\n\n"
+            logger.warning("[Chat] 流式生成回答失败", exc_info=True)
+            yield b"data: " + orjson.dumps(f"（生成回答时出错：{e}）") + b"\n\n"
         finally:
-            yield "data: [DONE]\n\n"
+            yield b"data: [DONE]\n\n"
 
     return StreamingResponse(
         event_generator(),
@@ -374,9 +689,28 @@ async def chat_stream(request: ChatRequest):
 
 if __name__ == "__main__":
     import uvicorn
+
+    # uvloop / httptools 随 uvicorn[standard] 安装；uvloop 不支持 Windows，此时退回 asyncio
+    try:
+        import uvloop  # noqa: F401
+        loop = "uvloop"
+    except ImportError:
+        loop = "asyncio"
+    try:
+        import httptools  # noqa: F401
+        http = "httptools"
+    except ImportError:
+        http = "h11"
+
+    # 多 worker 时各进程内存不共享（如后台索引任务状态），默认单 worker；
+    # reload 与多 worker 互斥，仅单 worker 时开启
+    workers = int(os.getenv("API_WORKERS", "1"))
     uvicorn.run(
         "backend.api:app",
         host=os.getenv("API_HOST", "0.0.0.0"),
         port=int(os.getenv("API_PORT", "8000")),
-        reload=True
+        loop=loop,
+        http=http,
+        workers=workers,
+        reload=workers == 1,
     )
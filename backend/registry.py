@@ -0,0 +1,200 @@
+"""SQLite-backed course workspace registry."""
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from backend.schemas import CourseWorkspace
+
+
+class WorkspaceRegistry:
+    """两张表：workspaces（课程元数据）和 documents（已上传文件名）。
+
+    CourseWorkspace 在首次访问时从 SQLite 懒加载，并用 LRU 缓存热点课程。
+    多个 uvicorn worker 通过 WAL 模式共享同一个库：每次写入都递增该课程的 version，
+    读取时先查 version，与缓存不一致（其他 worker 写过）就重新加载。
+    所有写操作都是单条 SQL 或单个事务，并发请求之间无需额外加锁。
+    """
+
+    def __init__(self, db_path: str = None, cache_size: int = 128, data_dir: str = None):
+        if db_path is None:
+            db_path = os.getenv("WORKSPACE_DB_PATH")
+        if db_path is None:
+            # 默认与 workspace 目录放在一起（DATA_DIR 的上一级），换数据目录时登记表随之切换
+            if data_dir is None:
+                data_dir = os.getenv("DATA_DIR", "./data/workspaces")
+            db_path = os.path.join(os.path.dirname(os.path.abspath(data_dir)), "workspaces.db")
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self._cache_size = cache_size
+        # course_name -> (version, CourseWorkspace)
+        self._cache: "OrderedDict[str, Tuple[int, CourseWorkspace]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._init_tables()
+
+    # ── 内部工具 ──────────────────────────────────────────────────────────────
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_tables(self):
+        with self._conn() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS workspaces (
+                    course_name   TEXT PRIMARY KEY,
+                    subject       TEXT NOT NULL DEFAULT '',
+                    created_at    TEXT NOT NULL,
+                    index_path    TEXT,
+                    notes_path    TEXT,
+                    mistakes_path TEXT,
+                    exams_path    TEXT,
+                    version       INTEGER NOT NULL DEFAULT 0
+                );
+
+                CREATE TABLE IF NOT EXISTS documents (
+                    course_name TEXT NOT NULL,
+                    filename    TEXT NOT NULL,
+                    PRIMARY KEY (course_name, filename)
+                );
+            """)
+            # 旧库没有 version 列时补上
+            cols = {r["name"] for r in conn.execute("PRAGMA table_info(workspaces)")}
+            if "version" not in cols:
+                conn.execute("ALTER TABLE workspaces ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    @staticmethod
+    def _bump(conn: sqlite3.Connection, course_name: str):
+        """与写入同一事务内递增 version，使其他 worker 的缓存失效。"""
+        conn.execute(
+            "UPDATE workspaces SET version = version + 1 WHERE course_name = ?", (course_name,)
+        )
+
+    def _invalidate(self, course_name: str):
+        with self._cache_lock:
+            self._cache.pop(course_name, None)
+
+    def _load(self, course_name: str) -> Optional[Tuple[int, CourseWorkspace]]:
+        with self._conn() as conn:
+            row = conn.execute(
+                "SELECT * FROM workspaces WHERE course_name = ?", (course_name,)
+            ).fetchone()
+            if row is None:
+                return None
+            docs = conn.execute(
+                "SELECT filename FROM documents WHERE course_name = ? ORDER BY filename",
+                (course_name,),
+            ).fetchall()
+        d = dict(row)
+        version = d.pop("version")
+        d["created_at"] = datetime.fromisoformat(d["created_at"])
+        d["documents"] = [r["filename"] for r in docs]
+        return version, CourseWorkspace(**d)
+
+    def _resolve(self, course_name: str, version: int) -> Optional[CourseWorkspace]:
+        """缓存中的 version 与库中一致时直接返回，否则重新加载并放入缓存。"""
+        with self._cache_lock:
+            entry = self._cache.get(course_name)
+            if entry is not None and entry[0] == version:
+                self._cache.move_to_end(course_name)
+                return entry[1]
+        # 先读 workspaces 行再读 documents：读库期间若有写入，缓存的 version 只会偏旧，下次读取时重新加载
+        loaded = self._load(course_name)
+        if loaded is None:
+            self._invalidate(course_name)
+            return None
+        with self._cache_lock:
+            self._cache[course_name] = loaded
+            self._cache.move_to_end(course_name)
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return loaded[1]
+
+    # ── 查询 ──────────────────────────────────────────────────────────────────
+
+    def get(self, course_name: str) -> Optional[CourseWorkspace]:
+        """按课程名获取 workspace，命中 LRU 缓存时只查询一次 version。"""
+        with self._conn() as conn:
+            row = conn.execute(
+                "SELECT version FROM workspaces WHERE course_name = ?", (course_name,)
+            ).fetchone()
+        if row is None:
+            self._invalidate(course_name)
+            return None
+        return self._resolve(course_name, row["version"])
+
+    def __contains__(self, course_name: str) -> bool:
+        return self.get(course_name) is not None
+
+    def list_all(self) -> List[CourseWorkspace]:
+        """列出所有 workspace（按创建时间排序）。"""
+        with self._conn() as conn:
+            rows = conn.execute(
+                "SELECT course_name, version FROM workspaces ORDER BY created_at"
+            ).fetchall()
+        workspaces = (self._resolve(r["course_name"], r["version"]) for r in rows)
+        return [ws for ws in workspaces if ws is not None]
+
+    def course_names(self) -> List[str]:
+        with self._conn() as conn:
+            rows = conn.execute("SELECT course_name FROM workspaces").fetchall()
+        return [r["course_name"] for r in rows]
+
+    # ── 写入 ──────────────────────────────────────────────────────────────────
+
+    def create(self, workspace: CourseWorkspace) -> bool:
+        """新建 workspace，已存在时返回 False（INSERT OR IGNORE 保证原子性）。"""
+        with self._conn() as conn:
+            cur = conn.execute(
+                """
+                INSERT OR IGNORE INTO workspaces
+                    (course_name, subject, created_at, index_path, notes_path, mistakes_path, exams_path)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    workspace.course_name, workspace.subject, workspace.created_at.isoformat(),
+                    workspace.index_path, workspace.notes_path,
+                    workspace.mistakes_path, workspace.exams_path,
+                ),
+            )
+            created = cur.rowcount == 1
+            if created and workspace.documents:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO documents (course_name, filename) VALUES (?, ?)",
+                    [(workspace.course_name, f) for f in workspace.documents],
+                )
+        self._invalidate(workspace.course_name)
+        return created
+
+    def add_document(self, course_name: str, filename: str):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO documents (course_name, filename) VALUES (?, ?)",
+                (course_name, filename),
+            )
+            self._bump(conn, course_name)
+        self._invalidate(course_name)
+
+    def remove_document(self, course_name: str, filename: str):
+        with self._conn() as conn:
+            conn.execute(
+                "DELETE FROM documents WHERE course_name = ? AND filename = ?",
+                (course_name, filename),
+            )
+            self._bump(conn, course_name)
+        self._invalidate(course_name)
+
+    def set_documents(self, course_name: str, filenames: List[str]):
+        """用磁盘实际文件列表整体替换某课程的文件记录。"""
+        with self._conn() as conn:
+            conn.execute("DELETE FROM documents WHERE course_name = ?", (course_name,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO documents (course_name, filename) VALUES (?, ?)",
+                [(course_name, f) for f in filenames],
+            )
+            self._bump(conn, course_name)
+        self._invalidate(course_name)
@@ -16,6 +16,22 @@ class CourseWorkspace(BaseModel):
     exams_path: Optional[str] = None
 
 
+class IndexJob(BaseModel):
+    """Background index build job."""
+    job_id: str
+    course_name: str
+    status: Literal["queued", "running", "done", "failed"] = "queued"
+    processed: int = 0  # 已解析文件数
+    total: int = 0      # 待解析文件总数
+    eta: Optional[float] = None  # 预计剩余秒数
+    num_chunks: Optional[int] = None
+    num_documents: Optional[int] = None
+    error: Optional[str] = None
+    traceback: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.now)
+    finished_at: Optional[datetime] = None
+
+
 class RetrievedChunk(BaseModel):
     """Retrieved document chunk with citation."""
     text: str
@@ -75,6 +91,13 @@ class ChatRequest(BaseModel):
     message: str
     history: List[ChatMessage] = Field(default_factory=list)
 
+    def history_dicts(self) -> List[Dict[str, Any]]:
+        """history 转 dict 列表：一次 model_dump 由 pydantic-core 遍历整个列表。
+
+        exclude_none 去掉空的 citations/tool_calls，普通消息只剩 role/content，可被直接复用。
+        """
+        return self.model_dump(include={"history"}, exclude_none=True)["history"]
+
 
 class ChatResponse(BaseModel):
     """Chat response."""
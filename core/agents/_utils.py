@@ -0,0 +1,87 @@
+"""Agent 共用的小工具。"""
+import re
+from typing import Any, Dict, Iterable, Optional
+
+import orjson
+
+# 匹配 ```json {...} ``` 或 ``` {...} ```，一次扫描取出第一个代码块里的对象
+_FENCE_RE = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```", re.DOTALL)
+
+
+def extract_json_block(text: str) -> Dict[str, Any]:
+    """从 LLM 回复中提取 JSON 对象，解析失败时抛出 ValueError（orjson.JSONDecodeError）。
+
+    优先取代码块；没有代码块（或输出被截断、代码块未闭合）时，
+    用 find/rfind 取第一个 "{" 到最后一个 "}" 之间的文本，不产生中间列表。
+    """
+    m = _FENCE_RE.search(text)
+    if m:
+        return orjson.loads(m.group(1))
+    start = text.find("{")
+    end = text.rfind("}")
+    if start < 0 or end < start:
+        raise ValueError("no JSON object found in response")
+    return orjson.loads(text[start:end + 1])
+
+
+class JsonObjectScanner:
+    """增量扫描流式文本，第一个顶层 JSON 对象的右花括号出现时即返回该对象的文本。
+
+    跟踪字符串字面量与转义，字符串里的花括号不计入深度。
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._started = False
+
+    def feed(self, text: str) -> Optional[str]:
+        """追加一段文本；对象闭合时返回完整对象文本，否则返回 None。"""
+        if not self._started:
+            start = text.find("{")
+            if start < 0:
+                return None
+            self._started = True
+            text = text[start:]
+
+        for j, ch in enumerate(text):
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._parts.append(text[:j + 1])
+                    return "".join(self._parts)
+        self._parts.append(text)
+        return None
+
+
+def parse_json_stream(chunks: Iterable[str]) -> Dict[str, Any]:
+    """从流式输出中解析第一个 JSON 对象，对象闭合后立即停止消费（并关闭生成器）。
+
+    流结束仍未得到完整对象时，回退到对整段文本做 extract_json_block。
+    """
+    scanner = JsonObjectScanner()
+    buffer = []
+    try:
+        for chunk in chunks:
+            buffer.append(chunk)
+            obj_text = scanner.feed(chunk)
+            if obj_text is not None:
+                return orjson.loads(obj_text)
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+    return extract_json_block("".join(buffer))
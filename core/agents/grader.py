@@ -1,10 +1,13 @@
 """Grader Agent for evaluating answers."""
-import json
+import logging
 from typing import List, Optional
 from core.llm.openai_compat import get_llm_client
-from core.orchestration.prompts import GRADER_PROMPT
+from core.agents._utils import extract_json_block
+from core.orchestration.prompts import render
 from backend.schemas import GradeReport, RetrievedChunk
 
+logger = logging.getLogger(__name__)
+
 
 class GraderAgent:
     """Grader agent for evaluating student answers."""
@@ -21,7 +24,8 @@ class GraderAgent:
         course_name: Optional[str] = None,
     ) -> GradeReport:
         """Grade student answer."""
-        prompt = GRADER_PROMPT.format(
+        prompt = render(
+            "grader",
             question=question,
             standard_answer=standard_answer,
             rubric=rubric,
@@ -37,14 +41,7 @@ class GraderAgent:
         
         # Parse response
         try:
-            if "```json" in response:
-                json_str = response.split("```json")[1].split("```")[0].strip()
-            elif "```" in response:
-                json_str = response.split("```")[1].split("```")[0].strip()
-            else:
-                json_str = response.strip()
-            
-            grade_dict = json.loads(json_str)
+            grade_dict = extract_json_block(response)
             report = GradeReport(
                 score=float(grade_dict.get("score", 0)),
                 feedback=grade_dict.get("feedback", ""),
@@ -62,7 +59,7 @@ class GraderAgent:
                 )
             return report
         except Exception as e:
-            print(f"Error parsing grade: {e}")
+            logger.warning("Error parsing grade: %s", e, exc_info=True)
             return GradeReport(
                 score=0.0,
                 feedback="评分时出错，请重试。",
@@ -99,4 +96,4 @@ class GraderAgent:
                 mgr.update_weak_points(course_name, mistake_tags)
             mgr.record_practice_result(course_name, score, is_mistake)
         except Exception as e:
-            print(f"[Memory] 错题记忆写入失败（不影响评分）: {e}")
+            logger.warning("[Memory] 错题记忆写入失败（不影响评分）: %s", e, exc_info=True)
@@ -1,9 +1,12 @@
 """QuizMaster Agent for generating questions."""
-import json
+import logging
 from core.llm.openai_compat import get_llm_client
-from core.orchestration.prompts import QUIZMASTER_PROMPT
+from core.agents._utils import extract_json_block
+from core.orchestration.prompts import render
 from backend.schemas import Quiz
 
+logger = logging.getLogger(__name__)
+
 
 class QuizMasterAgent:
     """QuizMaster agent for generating practice questions."""
@@ -19,7 +22,8 @@ class QuizMasterAgent:
         context: str
     ) -> Quiz:
         """Generate a quiz question."""
-        prompt = QUIZMASTER_PROMPT.format(
+        prompt = render(
+            "quizmaster",
             course_name=course_name,
             topic=topic,
             difficulty=difficulty,
@@ -35,17 +39,10 @@ class QuizMasterAgent:
         
         # Parse response
         try:
-            if "```json" in response:
-                json_str = response.split("```json")[1].split("```")[0].strip()
-            elif "```" in response:
-                json_str = response.split("```")[1].split("```")[0].strip()
-            else:
-                json_str = response.strip()
-            
-            quiz_dict = json.loads(json_str)
+            quiz_dict = extract_json_block(response)
             return Quiz(**quiz_dict)
         except Exception as e:
-            print(f"Error parsing quiz: {e}")
+            logger.warning("Error parsing quiz: %s", e, exc_info=True)
             # Return a default quiz
             return Quiz(
                 question="生成题目时出错，请重试。",
@@ -1,11 +1,26 @@
 """Router Agent for task planning."""
-import json
-from typing import Dict, Any
+import logging
+from typing import Dict
 from core.llm.openai_compat import get_llm_client
-from core.orchestration.prompts import ROUTER_PROMPT
+from core.agents._utils import parse_json_stream
+from core.orchestration.prompts import render
 from core.orchestration.policies import ToolPolicy
 from backend.schemas import Plan
 
+logger = logging.getLogger(__name__)
+
+# 各模式的兜底计划在导入时构建一次；调用方只读取 Plan，不修改，可直接共享
+_DEFAULT_PLANS: Dict[str, Plan] = {
+    m: Plan.model_construct(
+        need_rag=True,
+        allowed_tools=list(ToolPolicy.get_allowed_tools(m)),
+        task_type=m,
+        style="step_by_step",
+        output_format="answer",
+    )
+    for m in ("learn", "practice", "exam")
+}
+
 
 class RouterAgent:
     """Router agent for planning task execution."""
@@ -20,7 +35,8 @@ class RouterAgent:
         course_name: str
     ) -> Plan:
         """Generate execution plan."""
-        prompt = ROUTER_PROMPT.format(
+        prompt = render(
+            "router",
             mode=mode,
             course_name=course_name,
             user_message=user_message
@@ -31,33 +47,19 @@ class RouterAgent:
             {"role": "user", "content": prompt}
         ]
         
-        response = self.llm.chat(messages, temperature=0.3)
-        
-        # Parse response and create plan
+        # Parse response and create plan：流式读取，plan 对象的右花括号一出现就停止生成；
+        # 截至该处的输出即完整结果，因此提前关闭时也写入回答缓存
         try:
-            # Try to extract JSON from response
-            if "```json" in response:
-                json_str = response.split("```json")[1].split("```")[0].strip()
-            elif "```" in response:
-                json_str = response.split("```")[1].split("```")[0].strip()
-            else:
-                json_str = response.strip()
-            
-            plan_dict = json.loads(json_str)
+            plan_dict = parse_json_stream(
+                self.llm.chat_stream(messages, temperature=0.3, cache_on_close=True)
+            )
             
             # Override with policy if needed
-            allowed_tools = ToolPolicy.get_allowed_tools(mode)
-            plan_dict["allowed_tools"] = allowed_tools
+            plan_dict["allowed_tools"] = list(ToolPolicy.get_allowed_tools(mode))
             plan_dict["task_type"] = mode
             
             return Plan(**plan_dict)
         except Exception as e:
-            print(f"Error parsing plan: {e}, using defaults")
-            # Return default plan
-            return Plan(
-                need_rag=True,
-                allowed_tools=ToolPolicy.get_allowed_tools(mode),
-                task_type=mode,
-                style="step_by_step",
-                output_format="answer"
-            )
+            logger.warning("Error parsing plan: %s, using defaults", e)
+            # Return default plan（预构建、未经 Pydantic 校验；LLM 输出的分支仍完整校验）
+            return _DEFAULT_PLANS.get(mode) or _DEFAULT_PLANS["learn"]
@@ -1,74 +1,132 @@
 """Tutor Agent for learning mode."""
-from typing import List, Optional
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 from core.llm.openai_compat import get_llm_client
-from core.orchestration.prompts import TUTOR_PROMPT
+from core.orchestration.prompts import render
+from core.orchestration.history import window_with_summary
 from mcp_tools.client import get_tool_schemas
 from backend.schemas import RetrievedChunk
 
+try:
+    from memory.manager import get_memory_manager
+except Exception:  # 记忆模块不可用时不注入用户画像
+    get_memory_manager = None
+
+_BASE_SYSTEM_PROMPT = "你是一位专业的大学课程导师。"
+
+# 工具规则是固定文本，放在最前面；唯一的动态部分（可用工具列表）放在末尾，
+# 使 system prompt 前缀在各请求间保持一致，便于 LLM 服务端的前缀缓存命中
+_TOOL_RULES_PREFIX = (
+    _BASE_SYSTEM_PROMPT
+    + "规则：\n"
+    "1. 遇到数学计算，必须调用 calculator 工具，不要自己心算。\n"
+    "2. 优先从数据库中获取数据，遇到超出知识库的信息或者需要网络查询的信息（新闻/网络资料/日期/天气等），可以调用 websearch 工具，但仍然以数据库为准。\n"
+    "3. 用户明确要求保存笔记，必须调用 filewriter 工具，文件名用中文，格式为 .md。\n"
+    "4. 用户要求生成思维导图或知识点汇总，必须调用 mindmap_generator 工具。\n"
+    "5. 如果该知识点用户之前问过或做错过，可以调用 memory_search 工具检索历史记录。\n"
+    "6. 遇到询问当前日期、时间、星期几等时效性问题，必须调用 get_datetime 工具，不得凭记忆或训练数据回答。\n"
+    "7. 禁止编造工具调用结果，必须等待工具真实返回后再回答。\n"
+    "你可以使用以下工具："
+)
+
+
+# 用户画像摘要按课程缓存，TTL 内不重复查库（练习结果最多延迟 _PROFILE_TTL 秒体现）
+_PROFILE_TTL = 60.0
+_profile_cache: Dict[str, Tuple[float, str]] = {}
+
+
+def _get_profile(course_name: str) -> str:
+    """获取用户画像摘要（带 TTL 缓存），失败时返回空字符串，不影响主流程。"""
+    cached = _profile_cache.get(course_name)
+    now = time.monotonic()
+    if cached is not None and now - cached[0] < _PROFILE_TTL:
+        return cached[1]
+    if get_memory_manager is None:
+        return ""
+    try:
+        profile_ctx = get_memory_manager().get_profile_context(course_name)
+    except Exception:
+        return ""
+    _profile_cache[course_name] = (now, profile_ctx)
+    return profile_ctx
+
+
+@lru_cache(maxsize=64)
+def _schemas_for(tools: Tuple[str, ...]) -> Tuple[Dict, ...]:
+    """按工具集合缓存筛选后的 schema；返回的 dict 与 TOOL_SCHEMAS 共享，只读。"""
+    return tuple(get_tool_schemas(list(tools)))
+
+
+def _tool_schemas(allowed_tools: List[str]) -> List[Dict]:
+    return list(_schemas_for(tuple(sorted(allowed_tools))))
+
 
 class TutorAgent:
     """Tutor agent for teaching and explaining concepts."""
     
     def __init__(self):
         self.llm = get_llm_client()
-    
-    def teach(
+
+    @staticmethod
+    def _build_system_prompt(allowed_tools: Optional[List[str]]) -> str:
+        """静态规则在前、工具列表在后的 system prompt。"""
+        if not allowed_tools:
+            return _BASE_SYSTEM_PROMPT
+        return _TOOL_RULES_PREFIX + "、".join(allowed_tools) + "。"
+
+    def _build_messages(
         self,
         question: str,
         course_name: str,
         context: str,
-        allowed_tools: Optional[List[str]] = None,
-        history: Optional[List[dict]] = None
-    ) -> str:
-        """Generate teaching response, optionally with tool calling and conversation history."""
-        prompt = TUTOR_PROMPT.format(
+        allowed_tools: Optional[List[str]],
+        history: Optional[List[dict]],
+    ) -> List[dict]:
+        """构建 messages：system + 历史轮次 + 当前问题（teach / teach_stream 共用）。"""
+        prompt = render(
+            "tutor",
             course_name=course_name,
             context=context,
             question=question
         )
-
-        if allowed_tools:
-            schemas = get_tool_schemas(allowed_tools)
-            tool_desc = "、".join(allowed_tools)
-            system_prompt = (
-                f"你是一位专业的大学课程导师。"
-                f"你可以使用以下工具：{tool_desc}。"
-                f"规则：\n"
-                f"1. 遇到数学计算，必须调用 calculator 工具，不要自己心算。\n"
-                f"2. 优先从数据库中获取数据，遇到超出知识库的信息或者需要网络查询的信息，可以调用 websearch 工具。\n"
-                f"3. 用户明确要求保存笔记，必须调用 filewriter 工具，文件名用中文，格式为 .md。\n"
-                f"4. 用户要求生成思维导图或知识点汇总，必须调用 mindmap_generator 工具。\n"
-                f"5. 如果该知识点用户之前问过或做错过，可以调用 memory_search 工具检索历史记录。\n"
-                f"6. 遇到询问当前日期、时间、星期几等时效性问题，必须调用 get_datetime 工具，不得凭记忆或训练数据回答。\n"
-                f"7. 禁止编造工具调用结果，必须等待工具真实返回后再回答。"
-            )
-        else:
-            system_prompt = "你是一位专业的大学课程导师。"
+        system_prompt = self._build_system_prompt(allowed_tools)
 
         # 注入用户画像（薄弱知识点等），失败不影响主流程
-        try:
-            from memory.manager import get_memory_manager
-            profile_ctx = get_memory_manager().get_profile_context(course_name)
-            if profile_ctx:
-                system_prompt += f"\n\n【用户学习档案】{profile_ctx}"
-        except Exception:
-            pass
-
-        # 构建 messages：system + 历史轮次 + 当前问题
+        profile_ctx = _get_profile(course_name)
+        if profile_ctx:
+            system_prompt += f"\n\n【用户学习档案】{profile_ctx}"
+
         messages: List[dict] = [{"role": "system", "content": system_prompt}]
 
-        # 插入历史对话（最多保留最近 20 条，避免 token 超限）
+        # 插入历史对话：最近的轮次按 token 预算原样保留，更早的压缩为一条摘要，
+        # 既不撑爆上下文，也不丢失早期的约定和题目
         if history:
-            for msg in history[-20:]:
-                role = msg.get("role", "user")
-                content = msg.get("content", "")
-                if role in ("user", "assistant") and content:
-                    messages.append({"role": role, "content": content})
+            turns = [
+                {"role": msg["role"], "content": msg["content"]}
+                for msg in history
+                if msg.get("role") in ("user", "assistant") and msg.get("content")
+            ]
+            summary_msg, recent = window_with_summary(turns)
+            if summary_msg:
+                messages.append(summary_msg)
+            messages.extend(recent)
 
         messages.append({"role": "user", "content": prompt})
-
+        return messages
+    
+    def teach(
+        self,
+        question: str,
+        course_name: str,
+        context: str,
+        allowed_tools: Optional[List[str]] = None,
+        history: Optional[List[dict]] = None
+    ) -> str:
+        """Generate teaching response, optionally with tool calling and conversation history."""
+        messages = self._build_messages(question, course_name, context, allowed_tools, history)
         if allowed_tools:
-            return self.llm.chat_with_tools(messages, tools=schemas,
+            return self.llm.chat_with_tools(messages, tools=_tool_schemas(allowed_tools),
                                             temperature=0.7, max_tokens=2000)
         return self.llm.chat(messages, temperature=0.7, max_tokens=1500)
 
@@ -81,50 +139,9 @@ class TutorAgent:
         history: Optional[List[dict]] = None
     ):
         """流式版本的 teach()，返回文本 chunk 生成器。"""
-        prompt = TUTOR_PROMPT.format(
-            course_name=course_name,
-            context=context,
-            question=question
-        )
-
-        if allowed_tools:
-            schemas = get_tool_schemas(allowed_tools)
-            tool_desc = "、".join(allowed_tools)
-            system_prompt = (
-                f"你是一位专业的大学课程导师。"
-                f"你可以使用以下工具：{tool_desc}。"
-                f"规则：\n"
-                f"1. 遇到数学计算，必须调用 calculator 工具，不要自己心算。\n"
-                f"2. 优先从数据库中获取数据，遇到超出知识库的信息或者需要网络查询的信息（新闻/网络资料/日期/天气等），可以调用 websearch 工具，但仍然以数据库为准。\n"
-                f"3. 用户明确要求保存笔记，必须调用 filewriter 工具，文件名用中文，格式为 .md。\n"
-                f"4. 用户要求生成思维导图或知识点汇总，必须调用 mindmap_generator 工具。\n"
-                f"5. 如果该知识点用户之前问过或做错过，可以调用 memory_search 工具检索历史记录。\n"
-                f"6. 遇到询问当前日期、时间、星期几等时效性问题，必须调用 get_datetime 工具，不得凭记忆或训练数据回答。\n"
-                f"7. 禁止编造工具调用结果，必须等待工具真实返回后再回答。"
-            )
-        else:
-            system_prompt = "你是一位专业的大学课程导师。"
-
-        # 注入用户画像（薄弱知识点等），失败不影响主流程
-        try:
-            from memory.manager import get_memory_manager
-            profile_ctx = get_memory_manager().get_profile_context(course_name)
-            if profile_ctx:
-                system_prompt += f"\n\n【用户学习档案】{profile_ctx}"
-        except Exception:
-            pass
-
-        messages: List[dict] = [{"role": "system", "content": system_prompt}]
-        if history:
-            for msg in history[-20:]:
-                role = msg.get("role", "user")
-                content = msg.get("content", "")
-                if role in ("user", "assistant") and content:
-                    messages.append({"role": role, "content": content})
-        messages.append({"role": "user", "content": prompt})
-
+        messages = self._build_messages(question, course_name, context, allowed_tools, history)
         if allowed_tools:
-            yield from self.llm.chat_stream_with_tools(messages, tools=schemas,
+            yield from self.llm.chat_stream_with_tools(messages, tools=_tool_schemas(allowed_tools),
                                                        temperature=0.7, max_tokens=2000)
         else:
             yield from self.llm.chat_stream(messages, temperature=0.7, max_tokens=1500)
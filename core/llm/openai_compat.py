@@ -1,12 +1,161 @@
 """Core LLM client with OpenAI-compatible interface."""
 import os
 import json
-from typing import List, Dict, Any, Optional
-from openai import OpenAI
+import atexit
+import contextvars
+import importlib.util
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+import httpx
+import orjson
+from openai import DefaultHttpxClient, OpenAI
 from dotenv import load_dotenv
 
 load_dotenv()
 
+_tools_logger = logging.getLogger("chat_with_tools")
+_stream_tools_logger = logging.getLogger("chat_stream_with_tools")
+
+# 所有 agent 共用一个连接池；keep-alive 60s，避免对话间隔稍长就重新 TLS 握手（httpx 默认 5s）
+_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60)
+# 连接超时 5s 快速失败；读超时需覆盖非流式长回答（如整套试卷）的生成时间
+_HTTP_TIMEOUT = httpx.Timeout(float(os.getenv("LLM_TIMEOUT", "120")), connect=5.0)
+# 安装了 h2（pip install httpx[http2]）时启用 HTTP/2，并发请求复用同一条连接
+_HTTP2 = importlib.util.find_spec("h2") is not None
+
+# LLM 服务商类型：openai（默认，含 DeepSeek 等兼容端点）/ anthropic
+_LLM_PROVIDER = os.getenv("LLM_PROVIDER", "openai").lower()
+
+
+def _mark_cacheable(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """为 system prompt 打上 prompt caching 标记。
+
+    OpenAI / DeepSeek 对相同前缀自动缓存，只需保证 system 在前、动态内容在后，原样返回；
+    Anthropic 兼容端点需要显式 cache_control，把第一条 system 消息改写为带
+    {"type": "ephemeral"} 的 content block。不修改传入的列表。
+    """
+    if _LLM_PROVIDER != "anthropic":
+        return messages
+    for i, m in enumerate(messages):
+        if isinstance(m, dict) and m.get("role") == "system":
+            if not isinstance(m.get("content"), str):
+                return messages  # 已经标记过
+            marked = dict(m, content=[{
+                "type": "text",
+                "text": m["content"],
+                "cache_control": {"type": "ephemeral"},
+            }])
+            return messages[:i] + [marked] + messages[i + 1:]
+    return messages
+
+
+# 低温度（<= 0.3）的调用输出基本确定，相同输入直接复用上次回答（流式调用缓存拼接后的完整回答）
+_CACHEABLE_MAX_TEMPERATURE = 0.3
+
+
+class _ResponseCache:
+    """进程内 LRU + TTL 的 LLM 回答缓存（线程安全）。"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict[str, Any]], temperature: float,
+                 max_tokens: Optional[int]) -> Optional[str]:
+        try:
+            payload = orjson.dumps(messages, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            return None  # 含不可序列化对象（如 SDK message 对象），不缓存
+        digest = hashlib.blake2b(payload, digest_size=16).hexdigest()
+        return f"{digest}:{model}:{temperature}:{max_tokens}"
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            stored_at, value = item
+            if time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: str):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+# 回填给模型的单个工具结果上限（UTF-8 字节），websearch 等长结果超出部分截断
+_TOOL_RESULT_MAX_BYTES = int(os.getenv("TOOL_RESULT_MAX_BYTES", "8192"))
+_TRUNCATED_MARKER = "…[truncated]"
+
+
+def _encode_tool_result(tool_result: Any) -> str:
+    """工具结果只编码一次，写入 tool 消息的 content 字符串；超出字节预算时截断。
+
+    之后各轮请求里 content 都是普通 str，SDK 序列化时不再重复编码工具结果。
+    """
+    try:
+        encoded = orjson.dumps(tool_result, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    except TypeError:
+        encoded = json.dumps(tool_result, ensure_ascii=False, default=str)
+    if _TOOL_RESULT_MAX_BYTES > 0 and len(encoded) * 3 > _TOOL_RESULT_MAX_BYTES:
+        raw = encoded.encode("utf-8")
+        if len(raw) > _TOOL_RESULT_MAX_BYTES:
+            encoded = raw[:_TOOL_RESULT_MAX_BYTES].decode("utf-8", errors="ignore") + _TRUNCATED_MARKER
+    return encoded
+
+
+def _execute_tool_calls(tool_calls: List[Dict[str, Any]], logger, tag: str) -> List[Dict[str, Any]]:
+    """执行一轮中的全部 tool_calls，返回按原顺序排列的 tool 消息。
+
+    工具以 IO 为主（网络搜索、写文件等），同一轮有多个调用时并发执行，
+    该轮耗时从各工具耗时之和降为其中最大值。
+    """
+    from mcp_tools.client import MCPTools
+
+    def run(tool_call: Dict[str, Any]) -> Dict[str, Any]:
+        tool_name = tool_call["function"]["name"]
+        args_str = tool_call["function"]["arguments"] or ""
+        # get_datetime 等无参工具直接跳过解析
+        if not args_str or args_str == "{}":
+            tool_args = {}
+        else:
+            try:
+                tool_args = orjson.loads(args_str)
+            except orjson.JSONDecodeError:
+                tool_args = {}
+            if not isinstance(tool_args, dict):
+                tool_args = {}
+        logger.info("[%s] 执行工具 '%s'，参数: %s", tag, tool_name, tool_args)
+        tool_result = MCPTools.call_tool(tool_name, **tool_args)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("[%s] 工具 '%s' 结果: %.300s", tag, tool_name, tool_result)
+        return {
+            "role": "tool",
+            "tool_call_id": tool_call["id"],
+            "content": _encode_tool_result(tool_result),
+        }
+
+    if len(tool_calls) == 1:
+        return [run(tool_calls[0])]
+    # 每个工具在调用方上下文的副本中运行，请求级 ContextVar（如笔记目录）在工作线程里同样可见
+    contexts = [contextvars.copy_context() for _ in tool_calls]
+    with ThreadPoolExecutor(max_workers=len(tool_calls), thread_name_prefix="tool-call") as ex:
+        return list(ex.map(lambda ctx, tc: ctx.run(run, tc), contexts, tool_calls))
+
 
 class LLMClient:
     """OpenAI-compatible LLM client."""
@@ -23,8 +172,26 @@ class LLMClient:
         
         self.client = OpenAI(
             api_key=self.api_key,
-            base_url=self.base_url
+            base_url=self.base_url,
+            timeout=_HTTP_TIMEOUT,
+            http_client=DefaultHttpxClient(limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT, http2=_HTTP2),
         )
+        # LLM_CACHE_SIZE=0 关闭回答缓存
+        self._resp_cache = _ResponseCache(
+            maxsize=int(os.getenv("LLM_CACHE_SIZE", "256")),
+            ttl=float(os.getenv("LLM_CACHE_TTL", "3600")),
+        )
+
+    def close(self):
+        """关闭底层 HTTP 连接池。"""
+        self.client.close()
+
+    def _cache_key(self, messages: List[Dict[str, Any]], temperature: float,
+                   max_tokens: Optional[int], kwargs: Dict[str, Any]) -> Optional[str]:
+        """可缓存的调用返回缓存键，否则返回 None。"""
+        if kwargs or temperature > _CACHEABLE_MAX_TEMPERATURE or self._resp_cache.maxsize <= 0:
+            return None
+        return _ResponseCache.make_key(self.model, messages, temperature, max_tokens)
     
     def chat(
         self,
@@ -33,7 +200,17 @@ class LLMClient:
         max_tokens: Optional[int] = None,
         **kwargs
     ) -> str:
-        """Send chat completion request."""
+        """Send chat completion request.
+
+        temperature <= 0.3 且没有额外参数时，相同 (model, messages, temperature, max_tokens)
+        命中进程内缓存，直接返回上次的回答。
+        """
+        messages = _mark_cacheable(messages)
+        cache_key = self._cache_key(messages, temperature, max_tokens, kwargs)
+        if cache_key is not None:
+            cached = self._resp_cache.get(cache_key)
+            if cached is not None:
+                return cached
         try:
             response = self.client.chat.completions.create(
                 model=self.model,
@@ -42,9 +219,12 @@ class LLMClient:
                 max_tokens=max_tokens,
                 **kwargs
             )
-            return response.choices[0].message.content
+            content = response.choices[0].message.content
         except Exception as e:
             return f"Error calling LLM: {str(e)}"
+        if cache_key is not None and content:
+            self._resp_cache.put(cache_key, content)
+        return content
     
     def chat_with_tools(
         self,
@@ -54,16 +234,14 @@ class LLMClient:
         max_tokens: Optional[int] = None,
     ) -> str:
         """带 Function Calling 的对话，支持多轮工具调用直到 LLM 停止请求工具。"""
-        import logging
-        logger = logging.getLogger("chat_with_tools")
-        from mcp_tools.client import MCPTools
+        logger = _tools_logger
 
         if not tools:
             return self.chat(messages, temperature, max_tokens)
 
-        tool_names = [t["function"]["name"] for t in tools]
-        logger.info(f"[Tools] 可用工具: {tool_names}")
-        messages = list(messages)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("[Tools] 可用工具: %s", [t["function"]["name"] for t in tools])
+        messages = list(_mark_cacheable(messages))
         max_rounds = 6  # 最多 6 轮工具调用，防止死循环
 
         try:
@@ -80,44 +258,33 @@ class LLMClient:
 
                 # LLM 不再调用工具，返回最终答案
                 if not msg.tool_calls:
-                    logger.info(f"[Tools] 第 {round_idx+1} 轮：LLM 完成回答，未请求更多工具")
+                    logger.info("[Tools] 第 %d 轮：LLM 完成回答，未请求更多工具", round_idx + 1)
                     return msg.content or ""
 
-                logger.info(f"[Tools] 第 {round_idx+1} 轮：LLM 请求调用工具: "
-                            f"{[tc.function.name for tc in msg.tool_calls]}")
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("[Tools] 第 %d 轮：LLM 请求调用工具: %s",
+                                round_idx + 1, [tc.function.name for tc in msg.tool_calls])
 
+                tool_calls = [
+                    {
+                        "id": tc.id,
+                        "type": "function",
+                        "function": {
+                            "name": tc.function.name,
+                            "arguments": tc.function.arguments,
+                        },
+                    }
+                    for tc in msg.tool_calls
+                ]
                 # 把 assistant 消息加入历史
                 messages.append({
                     "role": "assistant",
                     "content": msg.content,
-                    "tool_calls": [
-                        {
-                            "id": tc.id,
-                            "type": "function",
-                            "function": {
-                                "name": tc.function.name,
-                                "arguments": tc.function.arguments,
-                            },
-                        }
-                        for tc in msg.tool_calls
-                    ],
+                    "tool_calls": tool_calls,
                 })
 
-                # 执行每个工具并把结果加入历史
-                for tool_call in msg.tool_calls:
-                    tool_name = tool_call.function.name
-                    try:
-                        tool_args = json.loads(tool_call.function.arguments)
-                    except json.JSONDecodeError:
-                        tool_args = {}
-                    logger.info(f"[Tools] 执行工具 '{tool_name}'，参数: {tool_args}")
-                    tool_result = MCPTools.call_tool(tool_name, **tool_args)
-                    logger.info(f"[Tools] 工具 '{tool_name}' 结果: {str(tool_result)[:300]}")
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": json.dumps(tool_result, ensure_ascii=False)
-                    })
+                # 执行本轮全部工具并把结果加入历史
+                messages.extend(_execute_tool_calls(tool_calls, logger, "Tools"))
 
             # 超过最大轮数，做一次不带工具的最终调用
             logger.warning("[Tools] 已达最大工具调用轮数，强制生成最终回答")
@@ -130,30 +297,102 @@ class LLMClient:
             return final.choices[0].message.content or ""
 
         except Exception as e:
-            print(f"[chat_with_tools] 工具调用失败，降级为普通对话: {e}")
+            logger.warning("[chat_with_tools] 工具调用失败，降级为普通对话: %s", e)
             return self.chat(messages, temperature, max_tokens)
 
     def chat_stream(
         self,
         messages: List[Dict[str, str]],
         temperature: float = 0.7,
+        max_tokens: Optional[int] = None,
+        cache_on_close: bool = False,
         **kwargs
     ):
-        """Send streaming chat completion request."""
+        """Send streaming chat completion request.
+
+        缓存规则与 chat 相同：命中时一次性产出缓存的回答。默认只有完整读完的流才写入缓存；
+        cache_on_close=True 表示调用方读到足够内容后会主动关闭生成器（如 parse_json_stream
+        拿到完整 JSON 即停止），此时缓存已读到的部分。中途出错的流不缓存。
+        """
+        messages = _mark_cacheable(messages)
+        cache_key = self._cache_key(messages, temperature, max_tokens, kwargs)
+        if cache_key is not None:
+            cached = self._resp_cache.get(cache_key)
+            if cached is not None:
+                yield cached
+                return
         try:
             stream = self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
                 temperature=temperature,
+                max_tokens=max_tokens,
                 stream=True,
                 **kwargs
             )
-            for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
+            parts = []
+            try:
+                for chunk in stream:
+                    if chunk.choices[0].delta.content:
+                        parts.append(chunk.choices[0].delta.content)
+                        yield parts[-1]
+                if cache_key is not None and parts:
+                    self._resp_cache.put(cache_key, "".join(parts))
+            except GeneratorExit:
+                if cache_on_close and cache_key is not None and parts:
+                    self._resp_cache.put(cache_key, "".join(parts))
+                raise
+            finally:
+                # 调用方提前停止迭代时关闭连接，服务端随即停止生成
+                stream.close()
         except Exception as e:
             yield f"Error calling LLM: {str(e)}"
 
+    def _stream_tool_round(
+        self,
+        messages: List[Dict[str, Any]],
+        tools: List[Dict],
+        temperature: float,
+        max_tokens: Optional[int],
+    ):
+        """流式执行一轮带工具的请求：文本增量直接 yield，tool_calls 分片按 index 拼接。
+
+        生成器的返回值为 (完整文本, tool_calls 列表)，tool_calls 为 OpenAI 消息格式的 dict。
+        """
+        stream = self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            tools=tools,
+            tool_choice="auto",
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+        )
+        parts: List[str] = []
+        calls: Dict[int, Dict[str, Any]] = {}
+        try:
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    parts.append(delta.content)
+                    yield delta.content
+                for tc in delta.tool_calls or ():
+                    slot = calls.setdefault(tc.index, {
+                        "id": "", "type": "function", "function": {"name": "", "arguments": ""},
+                    })
+                    if tc.id:
+                        slot["id"] = tc.id
+                    if tc.function is not None:
+                        if tc.function.name:
+                            slot["function"]["name"] += tc.function.name
+                        if tc.function.arguments:
+                            slot["function"]["arguments"] += tc.function.arguments
+        finally:
+            stream.close()
+        return "".join(parts), [calls[i] for i in sorted(calls)]
+
     def chat_stream_with_tools(
         self,
         messages: List[Dict[str, Any]],
@@ -161,85 +400,105 @@ class LLMClient:
         temperature: float = 0.7,
         max_tokens: Optional[int] = None,
     ):
-        """工具调用（非流式）后，将最终回答流式输出，返回生成器。"""
-        import logging
-        logger = logging.getLogger("chat_stream_with_tools")
-        from mcp_tools.client import MCPTools
+        """带工具调用的流式对话，返回生成器。
+
+        每一轮都以流式请求发出：模型直接回答时文本边生成边输出，不再额外请求一次；
+        模型请求工具时执行工具后进入下一轮。
+        """
+        logger = _stream_tools_logger
 
         if not tools:
             yield from self.chat_stream(messages, temperature, max_tokens=max_tokens)
             return
 
-        tool_names = [t["function"]["name"] for t in tools]
-        logger.info(f"[StreamTools] 可用工具: {tool_names}")
-        messages = list(messages)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("[StreamTools] 可用工具: %s", [t["function"]["name"] for t in tools])
+        messages = list(_mark_cacheable(messages))
         max_rounds = 6
+        emitted = False
 
         try:
             for round_idx in range(max_rounds):
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    tools=tools,
-                    tool_choice="auto",
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                )
-                msg = response.choices[0].message
+                rounds = self._stream_tool_round(messages, tools, temperature, max_tokens)
+                while True:
+                    try:
+                        piece = next(rounds)
+                    except StopIteration as stop:
+                        content, tool_calls = stop.value
+                        break
+                    emitted = True
+                    yield piece
 
-                if not msg.tool_calls:
-                    logger.info(f"[StreamTools] 第 {round_idx+1} 轮：工具调用完毕，开始流式输出")
-                    # 工具调用结束，用当前 messages 做流式最终回答
-                    yield from self.chat_stream(messages, temperature, max_tokens=max_tokens)
+                if not tool_calls:
+                    logger.info("[StreamTools] 第 %d 轮：LLM 完成回答，未请求更多工具", round_idx + 1)
                     return
 
-                logger.info(f"[StreamTools] 第 {round_idx+1} 轮：调用工具 "
-                            f"{[tc.function.name for tc in msg.tool_calls]}")
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("[StreamTools] 第 %d 轮：调用工具 %s",
+                                round_idx + 1, [tc["function"]["name"] for tc in tool_calls])
 
                 messages.append({
                     "role": "assistant",
-                    "content": msg.content,
-                    "tool_calls": [
-                        {
-                            "id": tc.id,
-                            "type": "function",
-                            "function": {"name": tc.function.name, "arguments": tc.function.arguments},
-                        }
-                        for tc in msg.tool_calls
-                    ],
+                    "content": content or None,
+                    "tool_calls": tool_calls,
                 })
 
-                for tool_call in msg.tool_calls:
-                    tool_name = tool_call.function.name
-                    try:
-                        tool_args = json.loads(tool_call.function.arguments)
-                    except json.JSONDecodeError:
-                        tool_args = {}
-                    logger.info(f"[StreamTools] 执行工具 '{tool_name}'，参数: {tool_args}")
-                    tool_result = MCPTools.call_tool(tool_name, **tool_args)
-                    logger.info(f"[StreamTools] 工具 '{tool_name}' 结果: {str(tool_result)[:300]}")
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": json.dumps(tool_result, ensure_ascii=False)
-                    })
+                messages.extend(_execute_tool_calls(tool_calls, logger, "StreamTools"))
 
             logger.warning("[StreamTools] 已达最大工具调用轮数，流式输出最终回答")
             yield from self.chat_stream(messages, temperature, max_tokens=max_tokens)
 
         except Exception as e:
-            logger.error(f"[StreamTools] 流式工具调用失败: {e}")
+            logger.error("[StreamTools] 流式工具调用失败: %s", e)
+            if emitted:
+                # 已经输出了部分回答，不再整段重来，避免重复内容
+                yield "\n\n（回答生成中断，请重试）"
+                return
             yield f"（工具调用出错，降级回答）\n"
             yield from self.chat_stream(messages, temperature, max_tokens=max_tokens)
 
 
 # Global LLM client instance
 _llm_client = None
+_llm_client_lock = threading.Lock()
 
 
 def get_llm_client() -> LLMClient:
-    """Get or create global LLM client."""
+    """Get or create global LLM client（进程内单例，线程安全）。"""
     global _llm_client
     if _llm_client is None:
-        _llm_client = LLMClient()
+        with _llm_client_lock:
+            if _llm_client is None:
+                _llm_client = LLMClient()
     return _llm_client
+
+
+def warmup_llm_client():
+    """后台预热：创建全局客户端并发一个轻量请求，提前完成 TCP/TLS 握手。
+
+    LLM_WARMUP=0 关闭；端点不支持 /models 时忽略错误（连接已建立即达到目的）。
+    """
+    if os.getenv("LLM_WARMUP", "1") != "1":
+        return
+    client = get_llm_client()
+
+    def _ping():
+        try:
+            client.client.models.list()
+        except Exception:
+            pass
+
+    threading.Thread(target=_ping, name="llm-warmup", daemon=True).start()
+
+
+def close_llm_client():
+    """关闭全局 LLM 客户端的连接池（服务退出时调用）。"""
+    global _llm_client
+    with _llm_client_lock:
+        if _llm_client is not None:
+            _llm_client.close()
+            _llm_client = None
+
+
+# CLI / Streamlit 等没有 FastAPI shutdown 钩子的入口，退出时同样释放连接池
+atexit.register(close_llm_client)
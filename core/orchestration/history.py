@@ -0,0 +1,147 @@
+"""对话历史窗口：按 token 预算截取最近的消息，更早的消息压缩成摘要。"""
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 历史消息的 token 预算（不含 system prompt 与当前问题）
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "4000"))
+
+# 原样保留的最近消息条数，以及更早消息的摘要 token 上限
+HISTORY_KEEP_MESSAGES = int(os.getenv("HISTORY_KEEP_MESSAGES", "10"))
+SUMMARY_TOKEN_BUDGET = 200
+
+# 每条消息的固定开销（role、分隔符等）
+_PER_MESSAGE_OVERHEAD = 8
+
+_tokenizer = None
+_tokenizer_loaded = False
+
+
+def _get_tokenizer():
+    """tiktoken 可用时返回 cl100k_base 编码器，否则返回 None（只尝试加载一次）。"""
+    global _tokenizer, _tokenizer_loaded
+    if not _tokenizer_loaded:
+        _tokenizer_loaded = True
+        try:
+            import tiktoken
+            _tokenizer = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _tokenizer = None
+    return _tokenizer
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本 token 数。
+
+    有 tiktoken 时精确计数；否则按中文约 1 字 1 token、ASCII 约 4 字符 1 token 估算。
+    UTF-8 下汉字占 3 字节，(字节数 - 字符数) / 2 即非 ASCII 字符数，全程走 C 实现。
+    """
+    enc = _get_tokenizer()
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    n_chars = len(text)
+    n_wide = (len(text.encode("utf-8")) - n_chars) // 2
+    return n_wide + (n_chars - n_wide) // 4
+
+
+def message_tokens(msg: Dict[str, str]) -> int:
+    return estimate_tokens(msg.get("content") or "") + _PER_MESSAGE_OVERHEAD
+
+
+def trim_by_tokens(
+    history: List[Dict[str, str]],
+    budget: Optional[int] = None,
+    approx: Callable[[Dict[str, str]], int] = message_tokens,
+) -> List[Dict[str, str]]:
+    """从末尾向前累加，返回不超过 budget 的最长后缀（保留最近的对话）。"""
+    if budget is None:
+        budget = HISTORY_TOKEN_BUDGET
+    used = 0
+    start = len(history)
+    for i in range(len(history) - 1, -1, -1):
+        cost = approx(history[i])
+        if used + cost > budget:
+            break
+        used += cost
+        start = i
+    if start:
+        logger.info("[History] trimmed_count=%d estimated_tokens=%d budget=%d", start, used, budget)
+    return history[start:]
+
+
+# 取第一句：遇到中英文句末标点或换行即截断
+_FIRST_SENTENCE_RE = re.compile(r"[^。！？!?\n]+[。！？!?]?")
+# 跳过 markdown 标题/列表/代码块等装饰，取第一句实际内容
+_MARKUP_PREFIX_RE = re.compile(r"^[\s#>*\-`|]+")
+
+_summary_cache: "OrderedDict[str, str]" = OrderedDict()
+_summary_cache_lock = threading.Lock()
+_SUMMARY_CACHE_SIZE = 128
+
+
+def _first_sentence(text: str, limit: int = 60) -> str:
+    m = _FIRST_SENTENCE_RE.search(_MARKUP_PREFIX_RE.sub("", text).replace("**", ""))
+    sentence = m.group(0).strip() if m else text.strip()
+    return sentence[:limit] + ("…" if len(sentence) > limit else "")
+
+
+def summarize_messages(messages: List[Dict[str, str]], budget: int = SUMMARY_TOKEN_BUDGET) -> str:
+    """不调用 LLM 的启发式摘要：每条用户消息记为「问」，每条助手回复取首句记为「答」。
+
+    超出 budget 时优先保留较新的条目；结果按消息内容哈希缓存，
+    只有滚出窗口的消息集合变化时才重新计算。
+    """
+    key = hashlib.blake2b(
+        "\x1e".join(f"{m['role']}\x1f{m['content']}" for m in messages).encode("utf-8"),
+        digest_size=16,
+    ).hexdigest()
+    with _summary_cache_lock:
+        cached = _summary_cache.get(key)
+        if cached is not None:
+            _summary_cache.move_to_end(key)
+            return cached
+
+    lines: List[str] = []
+    used = 0
+    for msg in reversed(messages):
+        prefix = "问" if msg["role"] == "user" else "答"
+        line = f"- {prefix}：{_first_sentence(msg['content'])}"
+        cost = estimate_tokens(line)
+        if used + cost > budget:
+            break
+        lines.append(line)
+        used += cost
+    summary = "\n".join(reversed(lines))
+
+    with _summary_cache_lock:
+        _summary_cache[key] = summary
+        if len(_summary_cache) > _SUMMARY_CACHE_SIZE:
+            _summary_cache.popitem(last=False)
+    return summary
+
+
+def window_with_summary(
+    history: List[Dict[str, str]],
+    keep: Optional[int] = None,
+    budget: Optional[int] = None,
+) -> Tuple[Optional[Dict[str, str]], List[Dict[str, str]]]:
+    """最近 keep 条（且不超过 token 预算）原样保留，其余压缩为一条 system 摘要消息。
+
+    返回 (summary_msg 或 None, recent_msgs)。
+    """
+    if keep is None:
+        keep = HISTORY_KEEP_MESSAGES
+    recent = trim_by_tokens(history[-keep:] if keep > 0 else [], budget)
+    older = history[:len(history) - len(recent)]
+    if not older:
+        return None, recent
+    summary = summarize_messages(older)
+    if not summary:
+        return None, recent
+    return {"role": "system", "content": f"此前对话摘要（较早的 {len(older)} 条消息）：\n{summary}"}, recent
@@ -1,5 +1,5 @@
 """Tool policy for different modes."""
-from typing import List, Literal
+from typing import Literal, Tuple
 
 
 class ToolPolicy:
@@ -10,13 +10,17 @@ class ToolPolicy:
         "practice": ["calculator", "filewriter", "memory_search", "get_datetime"],
         "exam":     ["calculator", "get_datetime"]
     }
+
+    # 每次请求都会查询：预先转成不可变结构，调用方无法改动共享的策略表
+    _POLICIES_TUPLE = {m: tuple(v) for m, v in MODE_POLICIES.items()}
+    _POLICIES_SET = {m: frozenset(v) for m, v in MODE_POLICIES.items()}
     
     @staticmethod
-    def get_allowed_tools(mode: Literal["learn", "practice", "exam"]) -> List[str]:
-        """Get allowed tools for a mode."""
-        return ToolPolicy.MODE_POLICIES.get(mode, [])
+    def get_allowed_tools(mode: Literal["learn", "practice", "exam"]) -> Tuple[str, ...]:
+        """Get allowed tools for a mode（只读元组）。"""
+        return ToolPolicy._POLICIES_TUPLE.get(mode, ())
     
     @staticmethod
     def is_tool_allowed(tool: str, mode: Literal["learn", "practice", "exam"]) -> bool:
         """Check if a tool is allowed in a mode."""
-        return tool in ToolPolicy.get_allowed_tools(mode)
+        return tool in ToolPolicy._POLICIES_SET.get(mode, frozenset())
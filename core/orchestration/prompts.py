@@ -1,4 +1,6 @@
 """Prompt templates for all agents."""
+import string
+from typing import Callable, Dict, List, Tuple
 
 ROUTER_PROMPT = """你是一个课程学习助手的任务规划器。根据用户请求和当前模式，制定执行计划。
 
@@ -343,3 +345,50 @@ D. …
 ---
 用户当前消息: {question}
 """
+
+
+def compile_template(template: str) -> Callable[..., str]:
+    """把 str.format 模板预拆分为字面量片段与字段槽位，返回与 template.format(**kw) 等价的渲染函数。
+
+    花括号解析只在导入时做一次；渲染时把各字段值填入片段列表的副本，一次 "".join 拼出结果，
+    context 达到数 KB 时比 % 格式化和 str.format 都快。
+    含下标/属性/格式说明符的字段（如 {difficulty_ratio[easy]}）直接回退到 template.format。
+    """
+    segments = list(string.Formatter().parse(template))
+    if any(field is not None and (not field.isidentifier() or spec or conv)
+           for _, field, spec, conv in segments):
+        return template.format
+    pieces: List[str] = []
+    slots: List[Tuple[int, str]] = []
+    for literal, field, _, _ in segments:
+        if literal:
+            pieces.append(literal)
+        if field is not None:
+            slots.append((len(pieces), field))
+            pieces.append("")
+
+    def render(**kwargs) -> str:
+        out = pieces.copy()
+        for i, name in slots:
+            value = kwargs[name]
+            out[i] = value if type(value) is str else format(value)
+        return "".join(out)
+
+    return render
+
+
+# 所有模板在导入时编译一次，调用方通过 render(name, **kwargs) 渲染
+_COMPILED_TEMPLATES: Dict[str, Callable[..., str]] = {
+    "router": compile_template(ROUTER_PROMPT),
+    "tutor": compile_template(TUTOR_PROMPT),
+    "quizmaster": compile_template(QUIZMASTER_PROMPT),
+    "grader": compile_template(GRADER_PROMPT),
+    "exam_generator": compile_template(EXAM_GENERATOR_PROMPT),
+    "practice": compile_template(PRACTICE_PROMPT),
+    "exam": compile_template(EXAM_PROMPT),
+}
+
+
+def render(name: str, **kwargs) -> str:
+    """渲染预编译的模板，结果与 <NAME>_PROMPT.format(**kwargs) 相同。"""
+    return _COMPILED_TEMPLATES[name](**kwargs)
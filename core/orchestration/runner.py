@@ -1,9 +1,20 @@
 """Main orchestration runner."""
+import logging
 import os
-import json
-from typing import Dict, Any, List, Optional
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+from itertools import islice
+import weakref
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor, wait as futures_wait
+from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime
 
+import orjson
+from pydantic import TypeAdapter
+
 from backend.schemas import (
     Plan, ChatMessage, RetrievedChunk, Quiz, GradeReport
 )
@@ -11,14 +22,221 @@ from core.agents.router import RouterAgent
 from core.agents.tutor import TutorAgent
 from core.agents.quizmaster import QuizMasterAgent
 from core.agents.grader import GraderAgent
-from rag.retrieve import Retriever
-from rag.store_faiss import FAISSStore
+from rag.retrieve import Retriever, get_retrieval_batcher
+from rag.store_faiss import FAISSStore, IndexIntegrityError
 from mcp_tools.client import MCPTools
-from core.orchestration.prompts import PRACTICE_PROMPT, EXAM_PROMPT
+from core.orchestration.prompts import render
+from core.orchestration.policies import ToolPolicy
+
+logger = logging.getLogger(__name__)
+
+_NO_MATERIAL_HINT = "（未找到相关教材，请先上传课程资料）"
+
+# 与 Router 的 LLM 调用并行执行 RAG 检索（检索以 IO 和 C 扩展为主，线程即可）
+_prefetch_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag-prefetch")
+
+# 检索结果：(格式化后的 context, 命中的 chunk 列表)
+Retrieved = Tuple[str, List[RetrievedChunk]]
+
+# 练习/考试记录等落盘操作放到后台单线程执行（单线程保证同一文件的追加顺序），
+# 保存提示可以立即返回给用户；退出前由 flush_pending_writes() 等待写完
+_write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="record-writer")
+_pending_writes: "weakref.WeakSet[Future]" = weakref.WeakSet()
+
+
+# 已确认存在的记录目录（只在写线程内访问）；目录被外部删除时 open 失败，重建后重试
+_ensured_dirs: set = set()
+
+
+def _open_in_dir(path: str, mode: str, **kwargs):
+    directory = os.path.dirname(path)
+    if directory not in _ensured_dirs:
+        os.makedirs(directory, exist_ok=True)
+        _ensured_dirs.add(directory)
+    try:
+        return open(path, mode, **kwargs)
+    except FileNotFoundError:
+        os.makedirs(directory, exist_ok=True)
+        return open(path, mode, **kwargs)
+
+
+def _write_text(path: str, text: str):
+    with _open_in_dir(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+# 追加写入的 jsonl 保持打开（无缓冲二进制，每行一次 write 直接落到内核），避免每条记录 open/close；
+# 只在写线程内访问，无需加锁
+_append_files: Dict[str, Any] = {}
+
+
+def _append_line(path: str, line: bytes):
+    f = _append_files.get(path)
+    if f is None:
+        f = _append_files[path] = _open_in_dir(path, "ab", buffering=0)
+    f.write(line)
+
+
+def _close_append_files():
+    for f in _append_files.values():
+        f.close()
+    _append_files.clear()
+
+
+def _submit_background(fn, *args):
+    """把落盘类任务（记录文件、情景记忆）交给后台写线程，按提交顺序执行。"""
+    future = _write_pool.submit(fn, *args)
+    _pending_writes.add(future)
+    future.add_done_callback(_log_write_error)
+
+
+def _submit_write(path: str, text: str):
+    _submit_background(_write_text, path, text)
+
+
+def _log_write_error(future: Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("[Record] 记录写入失败", exc_info=future.exception())
+
+
+def flush_pending_writes(timeout: float = None):
+    """等待所有后台记录写入完成并关闭追加句柄（服务退出时调用）。"""
+    _submit_background(_close_append_files)
+    futures_wait(list(_pending_writes), timeout=timeout)
+
+
+# 记录文件名与正文中的时间格式；同一条记录只取一次 now，文件名和正文时间一致
+_FILE_TS_FORMAT = "%Y%m%d_%H%M%S"
+_DISPLAY_TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+# 评分/批改阶段的特征词：预编译为一个多选正则，一次扫描回复全文，凑够 2 个不同关键词即返回
+_PRACTICE_GRADING_KEYWORDS = ("评分结果", "标准解析", "易错提醒", "得分", "答对的部分", "需要改进", "逐题核对", "标准答案", "学生答案")
+_EXAM_GRADING_KEYWORDS = ("批改报告", "逐题详批", "评分总表", "总得分", "总分", "考后建议", "薄弱知识点")
+_PRACTICE_GRADING_RE = re.compile("|".join(map(re.escape, _PRACTICE_GRADING_KEYWORDS)))
+_EXAM_GRADING_RE = re.compile("|".join(map(re.escape, _EXAM_GRADING_KEYWORDS)))
+
+
+def _has_two_keywords(pattern: "re.Pattern[str]", text: str) -> bool:
+    seen = set()
+    for m in pattern.finditer(text):
+        seen.add(m.group())
+        if len(seen) >= 2:
+            return True
+    return False
+
+
+# 练习模式中不需要检索教材的消息：换题/调难度等追问，或对上一道题的作答
+_PRACTICE_FOLLOWUP_RE = re.compile(r"^\s*(再来|下一|换一|继续|简单|难一点|easier|harder)", re.IGNORECASE)
+# 出题阶段回复的固定结尾（见 PRACTICE_PROMPT），出现在上一条助手消息中说明题目待作答
+_PRACTICE_QUESTION_TAIL = "请回答上述问题"
+_PRACTICE_MIN_RAG_CHARS = 8
+
+# 路由结果固定的场景直接使用预构建的计划，省去一次 Router LLM 调用：
+# exam 模式总是检索、不走工具调用；练习作答/追问不检索，只依赖对话历史
+_FIXED_PLANS: Dict[str, Plan] = {
+    "exam": Plan.model_construct(
+        need_rag=True,
+        allowed_tools=list(ToolPolicy.get_allowed_tools("exam")),
+        task_type="exam",
+        style="step_by_step",
+        output_format="exam",
+    ),
+}
+_PRACTICE_FOLLOWUP_PLAN = Plan.model_construct(
+    need_rag=False,
+    allowed_tools=list(ToolPolicy.get_allowed_tools("practice")),
+    task_type="practice",
+    style="step_by_step",
+    output_format="answer",
+)
+
+
+def _practice_needs_rag(user_message: str, history: List[Dict[str, str]]) -> bool:
+    """练习模式的检索启发式：作答与追问只依赖对话历史，跳过 embedding 与向量检索。"""
+    if len(user_message.strip()) < _PRACTICE_MIN_RAG_CHARS:
+        return False
+    if _PRACTICE_FOLLOWUP_RE.match(user_message):
+        return False
+    for msg in reversed(history):
+        if msg.get("role") == "assistant":
+            return _PRACTICE_QUESTION_TAIL not in (msg.get("content") or "")
+    return True
+
+
+# 试卷回复的特征词，用于从历史中找出本次考试的试卷
+_EXAM_PAPER_NEEDLES = ("模拟考试试卷", "第一部分", "第二部分")
+
+
+def _locate_history_context(
+    history: List[Dict[str, str]], limit: int, paper_needles: Tuple[str, ...] = (),
+) -> Tuple[Optional[str], Optional[str]]:
+    """一次逆序遍历最近 limit 条历史，返回 (最近一条助手消息, 最近一条含试卷特征词的助手消息)。"""
+    last = None
+    for msg in islice(reversed(history), limit):
+        if msg.get("role") != "assistant":
+            continue
+        content = msg.get("content", "")
+        if last is None:
+            last = content
+            if not paper_needles:
+                break
+        if any(n in content for n in paper_needles):
+            return last, content
+    return last, None
+
+
+# 练习/考试模式的 system 消息是常量，每轮直接引用同一个 dict
+_PRACTICE_SYSTEM_MSG = {"role": "system", "content": "你是一位专业的课程练习导师，负责出题、评分和讲解。严格按照用户提示词中的对话规则执行。"}
+_EXAM_SYSTEM_MSG = {"role": "system", "content": "你是一位严肃公正的考试主考官，严格按照三阶段对话规则执行：阶段一收集配置、阶段二生成试卷、阶段三批改评分。禁止跨阶段操作，禁止在试卷中透露答案。"}
+_CHAT_ROLES = frozenset(("user", "assistant"))
+_CHAT_KEYS = frozenset(("role", "content"))
+
+
+def _build_messages(system_msg: Dict[str, str], history: List[Dict[str, str]],
+                    limit: int, prompt: str) -> List[Dict[str, str]]:
+    """system + 最近 limit 条 user/assistant 历史（跳过空内容）+ 本轮提示词。
+
+    历史里符合格式的消息直接复用原 dict，不再逐条重建。
+    """
+    messages = [system_msg]
+    messages.extend(
+        m if m.keys() == _CHAT_KEYS else {"role": m.get("role", "user"), "content": m["content"]}
+        for m in history[-limit:]
+        if m.get("role", "user") in _CHAT_ROLES and m.get("content")
+    )
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def _iterate_in_context(ctx: contextvars.Context, gen):
+    """每一步都在同一个 Context 中驱动生成器。
+
+    StreamingResponse 在线程池里逐次调用 next()，每次使用不同的上下文副本；
+    固定 Context 后，生成器内部（含工具执行）始终能读到本请求设置的 ContextVar。
+    """
+    try:
+        while True:
+            try:
+                item = ctx.run(next, gen)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        gen.close()
+
+
+# 整个列表交给 pydantic-core 一次性转 dict，代替逐个 model_dump()
+_CHUNK_LIST_ADAPTER = TypeAdapter(List[RetrievedChunk])
 
 
 class OrchestrationRunner:
     """Main orchestration runner for the course agent system."""
+
+    # 检索结果 LRU 缓存条数（同一课程同一问题重复提问时跳过 embedding 与向量检索）
+    RETRIEVAL_CACHE_SIZE = 256
+    # 常驻内存的课程索引数（mmap 加载时只占页缓存，非 mmap 时为完整向量矩阵）
+    RETRIEVER_CACHE_SIZE = 32
     
     def __init__(self, data_dir: str = None):
         if data_dir is None:
@@ -31,6 +249,12 @@ class OrchestrationRunner:
         self.quizmaster = QuizMasterAgent()
         self.grader = GraderAgent()
         self.tools = MCPTools()
+
+        self._retrieval_cache: "OrderedDict[str, Retrieved]" = OrderedDict()
+        self._retrieval_cache_lock = threading.Lock()
+        # course_name -> ((mtime_ns, size), Retriever)
+        self._retriever_cache: "OrderedDict[str, Tuple[Tuple[int, int], Retriever]]" = OrderedDict()
+        self._retriever_cache_lock = threading.Lock()
     
     def get_workspace_path(self, course_name: str) -> str:
         """Get workspace path for a course. Sanitizes course_name to prevent path traversal."""
@@ -40,24 +264,109 @@ class OrchestrationRunner:
             raise ValueError(f"无效的课程名称: {course_name!r}")
         return os.path.join(self.data_dir, safe_name)
     
-    def load_retriever(self, course_name: str) -> Optional[Retriever]:
-        """Load retriever for a course."""
+    def _index_path(self, course_name: str) -> str:
         workspace_path = self.get_workspace_path(course_name)
-        index_path = os.path.abspath(os.path.join(workspace_path, "index", "faiss_index"))
-        
-        if not os.path.exists(f"{index_path}.faiss"):
+        return os.path.abspath(os.path.join(workspace_path, "index", "faiss_index"))
+
+    def load_retriever(self, course_name: str) -> Optional[Retriever]:
+        """Load retriever for a course.
+
+        每门课程的 Retriever 常驻缓存，以索引文件的 (mtime, size) 判断是否需要重新加载；
+        索引重建（原子替换文件）后下一次调用自动读取新索引。
+        """
+        index_path = self._index_path(course_name)
+        try:
+            st = os.stat(f"{index_path}.faiss")
+        except FileNotFoundError:
+            with self._retriever_cache_lock:
+                self._retriever_cache.pop(course_name, None)
             return None
+        version = (st.st_mtime_ns, st.st_size)
+        with self._retriever_cache_lock:
+            cached = self._retriever_cache.get(course_name)
+            if cached is not None and cached[0] == version:
+                self._retriever_cache.move_to_end(course_name)
+                return cached[1]
         
         store = FAISSStore()
-        store.load(index_path)
-        return Retriever(store)
+        try:
+            store.load(index_path)
+        except IndexIntegrityError as e:
+            logger.warning("[RAG] 索引不可用，请重新构建: %s", e)
+            return None
+        retriever = Retriever(store)
+        with self._retriever_cache_lock:
+            self._retriever_cache[course_name] = (version, retriever)
+            self._retriever_cache.move_to_end(course_name)
+            if len(self._retriever_cache) > self.RETRIEVER_CACHE_SIZE:
+                self._retriever_cache.popitem(last=False)
+        return retriever
+
+    def retrieve_context(self, course_name: str, query: str, top_k: int = None) -> Retrieved:
+        """检索课程资料，返回 (context, chunks)；没有索引时返回提示语和空列表。
+
+        结果按 (课程, top_k, 索引文件 mtime, 问题) 缓存：索引重建后 mtime 变化，旧条目自然失效。
+        """
+        try:
+            index_mtime = os.stat(f"{self._index_path(course_name)}.faiss").st_mtime_ns
+        except FileNotFoundError:
+            return _NO_MATERIAL_HINT, []
+        key = hashlib.blake2b(
+            f"{course_name}\x1f{top_k}\x1f{index_mtime}\x1f{query}".encode("utf-8"),
+            digest_size=16,
+        ).hexdigest()
+        with self._retrieval_cache_lock:
+            cached = self._retrieval_cache.get(key)
+            if cached is not None:
+                self._retrieval_cache.move_to_end(key)
+                return cached
+
+        retriever = self.load_retriever(course_name)
+        if not retriever:
+            return _NO_MATERIAL_HINT, []
+        # 经批处理线程检索：并发请求同一课程时合并为一次编码 + 一次向量搜索
+        chunks = get_retrieval_batcher().submit(retriever, query, top_k).result()
+        result = (retriever.format_context(chunks), chunks)
+        with self._retrieval_cache_lock:
+            self._retrieval_cache[key] = result
+            if len(self._retrieval_cache) > self.RETRIEVAL_CACHE_SIZE:
+                self._retrieval_cache.popitem(last=False)
+        return result
+
+    def plan_and_retrieve(
+        self,
+        course_name: str,
+        mode: str,
+        user_message: str,
+        history: List[Dict[str, str]] = None,
+    ) -> Tuple[Plan, Optional[Retrieved]]:
+        """Router 规划与 RAG 检索并行执行。
+
+        learn/practice 的 need_rag 默认为 True，因此先投机启动检索；
+        Router 返回 need_rag=False 时丢弃检索结果。
+        exam 模式与练习作答/追问的路由结果固定，直接使用预构建计划，不调用 Router；
+        后者由启发式判断跳过检索，返回空 context。
+        """
+        if mode == "exam":
+            return _FIXED_PLANS["exam"], self.retrieve_context(course_name, user_message, top_k=12)
+        if mode not in ("learn", "practice"):
+            return self.router.plan(user_message, mode, course_name), None
+        if mode == "practice" and not _practice_needs_rag(user_message, history or []):
+            return _PRACTICE_FOLLOWUP_PLAN, ("", [])
+        future = _prefetch_pool.submit(self.retrieve_context, course_name, user_message)
+        plan = self.router.plan(user_message, mode, course_name)
+        if not plan.need_rag:
+            future.cancel()
+            return plan, None
+        return plan, future.result()
     
     def run_learn_mode(
         self,
         course_name: str,
         user_message: str,
         plan: Plan,
-        history: List[Dict[str, str]] = None
+        history: List[Dict[str, str]] = None,
+        retrieved: Optional[Retrieved] = None,
     ) -> ChatMessage:
         """Execute learn mode."""
         if history is None:
@@ -67,23 +376,19 @@ class OrchestrationRunner:
         citations = []
         
         if plan.need_rag:
-            retriever = self.load_retriever(course_name)
-            if retriever:
-                chunks = retriever.retrieve(user_message)
-                context = retriever.format_context(chunks)
-                citations = chunks
-            else:
-                context = "（未找到相关教材，请先上传课程资料）"
+            context, citations = retrieved or self.retrieve_context(course_name, user_message)
         
         # Generate teaching response
         workspace_path = self.get_workspace_path(course_name)
         notes_dir = os.path.abspath(os.path.join(workspace_path, "notes"))
-        # 为 filewriter 工具注入当前课程的笔记目录
-        from mcp_tools.client import MCPTools
-        MCPTools._context = {"notes_dir": notes_dir}
-        response_text = self.tutor.teach(user_message, course_name, context,
-                                         allowed_tools=plan.allowed_tools,
-                                         history=history)
+        # 为 filewriter 工具注入当前课程的笔记目录（仅对本请求可见）
+        token = MCPTools._context_var.set({"notes_dir": notes_dir})
+        try:
+            response_text = self.tutor.teach(user_message, course_name, context,
+                                             allowed_tools=plan.allowed_tools,
+                                             history=history)
+        finally:
+            MCPTools._context_var.reset(token)
         
         return ChatMessage(
             role="assistant",
@@ -99,6 +404,7 @@ class OrchestrationRunner:
         plan: Plan,
         state: Dict[str, Any] = None,
         history: List[Dict[str, str]] = None,
+        retrieved: Optional[Retrieved] = None,
     ) -> ChatMessage:
         """对话式练习模式：LLM 根据历史自动判断出题/评分，无需 state。"""
         if history is None:
@@ -107,37 +413,25 @@ class OrchestrationRunner:
         context = ""
         citations = []
         if plan.need_rag:
-            retriever = self.load_retriever(course_name)
-            if retriever:
-                chunks = retriever.retrieve(user_message)
-                context = retriever.format_context(chunks)
-                citations = chunks
-            else:
-                context = "（未找到相关教材，请先上传课程资料）"
+            context, citations = retrieved or self.retrieve_context(course_name, user_message)
 
-        prompt = PRACTICE_PROMPT.format(
+        prompt = render(
+            "practice",
             course_name=course_name,
             context=context,
             question=user_message,
         )
 
-        messages: List[dict] = [
-            {"role": "system", "content": "你是一位专业的课程练习导师，负责出题、评分和讲解。严格按照用户提示词中的对话规则执行。"}
-        ]
-        for msg in history[-20:]:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            if role in ("user", "assistant") and content:
-                messages.append({"role": role, "content": content})
-        messages.append({"role": "user", "content": prompt})
+        messages = _build_messages(_PRACTICE_SYSTEM_MSG, history, 20, prompt)
 
         llm = self.tutor.llm
         response_text = llm.chat(messages, temperature=0.7, max_tokens=2000)
 
         # 评分阶段自动保存记录
         if self._is_practice_grading(response_text):
-            saved_path = self._save_practice_record(course_name, user_message, history, response_text)
-            self._save_grading_to_memory(course_name, user_message, history, response_text)
+            quiz_content, _ = _locate_history_context(history, 20)
+            saved_path = self._save_practice_record(course_name, user_message, quiz_content, response_text)
+            _submit_background(self._save_grading_to_memory, course_name, user_message, quiz_content, response_text)
             response_text += f"\n\n---\n📁 **本题记录已保存至**：`{saved_path}`"
 
         return ChatMessage(
@@ -153,6 +447,7 @@ class OrchestrationRunner:
         user_message: str,
         plan: Plan,
         history: List[Dict[str, str]] = None,
+        retrieved: Optional[Retrieved] = None,
     ):
         """对话式练习模式流式版本。"""
         if history is None:
@@ -160,38 +455,28 @@ class OrchestrationRunner:
 
         context = ""
         if plan.need_rag:
-            retriever = self.load_retriever(course_name)
-            if retriever:
-                chunks = retriever.retrieve(user_message)
-                context = retriever.format_context(chunks)
-            else:
-                context = "（未找到相关教材，请先上传课程资料）"
+            context, _ = retrieved or self.retrieve_context(course_name, user_message)
 
-        prompt = PRACTICE_PROMPT.format(
+        prompt = render(
+            "practice",
             course_name=course_name,
             context=context,
             question=user_message,
         )
 
-        messages: List[dict] = [
-            {"role": "system", "content": "你是一位专业的课程练习导师，负责出题、评分和讲解。严格按照用户提示词中的对话规则执行。"}
-        ]
-        for msg in history[-20:]:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            if role in ("user", "assistant") and content:
-                messages.append({"role": role, "content": content})
-        messages.append({"role": "user", "content": prompt})
+        messages = _build_messages(_PRACTICE_SYSTEM_MSG, history, 20, prompt)
 
         llm = self.tutor.llm
         collected = []
+        append = collected.append  # 每个 chunk 一次局部变量读取，省去属性查找
         for chunk in llm.chat_stream(messages, temperature=0.7, max_tokens=2000):
-            collected.append(chunk)
+            append(chunk)
             yield chunk
         full_response = "".join(collected)
         if self._is_practice_grading(full_response):
-            saved_path = self._save_practice_record(course_name, user_message, history, full_response)
-            self._save_grading_to_memory(course_name, user_message, history, full_response)
+            quiz_content, _ = _locate_history_context(history, 20)
+            saved_path = self._save_practice_record(course_name, user_message, quiz_content, full_response)
+            _submit_background(self._save_grading_to_memory, course_name, user_message, quiz_content, full_response)
             yield f"\n\n---\n📁 **本题记录已保存至**：`{saved_path}`"
 
     
@@ -201,42 +486,31 @@ class OrchestrationRunner:
         user_message: str,
         plan: Plan,
         history: list = None,
+        retrieved: Optional[Retrieved] = None,
     ) -> ChatMessage:
         """对话式考试模式：LLM 根据历史自动判断出卷/评分。"""
         if history is None:
             history = []
 
-        context = ""
-        retriever = self.load_retriever(course_name)
-        if retriever:
-            chunks = retriever.retrieve(user_message, top_k=12)
-            context = retriever.format_context(chunks)
-        else:
-            context = "（未找到相关教材，请先上传课程资料）"
+        context, _ = retrieved or self.retrieve_context(course_name, user_message, top_k=12)
 
-        prompt = EXAM_PROMPT.format(
+        prompt = render(
+            "exam",
             course_name=course_name,
             context=context,
             question=user_message,
         )
 
-        messages = [
-            {"role": "system", "content": "你是一位严肃公正的考试主考官，严格按照三阶段对话规则执行：阶段一收集配置、阶段二生成试卷、阶段三批改评分。禁止跨阶段操作，禁止在试卷中透露答案。"}
-        ]
-        for msg in history[-30:]:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            if role in ("user", "assistant") and content:
-                messages.append({"role": role, "content": content})
-        messages.append({"role": "user", "content": prompt})
+        messages = _build_messages(_EXAM_SYSTEM_MSG, history, 30, prompt)
 
         llm = self.tutor.llm
         response_text = llm.chat(messages, temperature=0.5, max_tokens=4000)
 
         # 批改阶段自动保存记录
         if self._is_exam_grading(response_text):
-            saved_path = self._save_exam_record(course_name, user_message, history, response_text)
-            self._save_exam_to_memory(course_name, response_text)
+            _, exam_paper = _locate_history_context(history, 30, _EXAM_PAPER_NEEDLES)
+            saved_path = self._save_exam_record(course_name, user_message, exam_paper, response_text)
+            _submit_background(self._save_exam_to_memory, course_name, response_text)
             response_text += f"\n\n---\n📁 **本次考试记录已保存至**：`{saved_path}`"
 
         return ChatMessage(
@@ -252,44 +526,34 @@ class OrchestrationRunner:
         user_message: str,
         plan: Plan,
         history: list = None,
+        retrieved: Optional[Retrieved] = None,
     ):
         """对话式考试模式流式版本。"""
         if history is None:
             history = []
 
-        context = ""
-        retriever = self.load_retriever(course_name)
-        if retriever:
-            chunks = retriever.retrieve(user_message, top_k=12)
-            context = retriever.format_context(chunks)
-        else:
-            context = "（未找到相关教材，请先上传课程资料）"
+        context, _ = retrieved or self.retrieve_context(course_name, user_message, top_k=12)
 
-        prompt = EXAM_PROMPT.format(
+        prompt = render(
+            "exam",
             course_name=course_name,
             context=context,
             question=user_message,
         )
 
-        messages = [
-            {"role": "system", "content": "你是一位严肃公正的考试主考官，严格按照三阶段对话规则执行：阶段一收集配置、阶段二生成试卷、阶段三批改评分。禁止跨阶段操作，禁止在试卷中透露答案。"}
-        ]
-        for msg in history[-30:]:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            if role in ("user", "assistant") and content:
-                messages.append({"role": role, "content": content})
-        messages.append({"role": "user", "content": prompt})
+        messages = _build_messages(_EXAM_SYSTEM_MSG, history, 30, prompt)
 
         llm = self.tutor.llm
         collected = []
+        append = collected.append  # 每个 chunk 一次局部变量读取，省去属性查找
         for chunk in llm.chat_stream(messages, temperature=0.5, max_tokens=4000):
-            collected.append(chunk)
+            append(chunk)
             yield chunk
         full_response = "".join(collected)
         if self._is_exam_grading(full_response):
-            saved_path = self._save_exam_record(course_name, user_message, history, full_response)
-            self._save_exam_to_memory(course_name, full_response)
+            _, exam_paper = _locate_history_context(history, 30, _EXAM_PAPER_NEEDLES)
+            saved_path = self._save_exam_record(course_name, user_message, exam_paper, full_response)
+            _submit_background(self._save_exam_to_memory, course_name, full_response)
             yield f"\n\n---\n📁 **本次考试记录已保存至**：`{saved_path}`"
 
     def _save_mistake(
@@ -302,7 +566,6 @@ class OrchestrationRunner:
         """Save mistake to log."""
         workspace_path = self.get_workspace_path(course_name)
         mistakes_dir = os.path.join(workspace_path, "mistakes")
-        os.makedirs(mistakes_dir, exist_ok=True)
         
         mistake_file = os.path.join(mistakes_dir, "mistakes.jsonl")
         
@@ -316,8 +579,7 @@ class OrchestrationRunner:
             "mistake_tags": grade_report.mistake_tags
         }
         
-        with open(mistake_file, 'a', encoding='utf-8') as f:
-            f.write(json.dumps(mistake_entry, ensure_ascii=False) + '\n')
+        _submit_background(_append_line, mistake_file, orjson.dumps(mistake_entry) + b"\n")
 
     # ------------------------------------------------------------------ #
     #  记录检测 & 自动保存辅助方法
@@ -325,27 +587,24 @@ class OrchestrationRunner:
 
     def _is_practice_grading(self, text: str) -> bool:
         """判断练习模式回复是否为评分阶段。"""
-        keywords = ["评分结果", "标准解析", "易错提醒", "得分", "答对的部分", "需要改进", "逐题核对", "标准答案", "学生答案"]
-        return sum(1 for kw in keywords if kw in text) >= 2
+        return _has_two_keywords(_PRACTICE_GRADING_RE, text)
 
     def _save_grading_to_memory(
         self,
         course_name: str,
         user_answer: str,
-        history: list,
+        question: Optional[str],
         response_text: str,
     ) -> None:
-        """将练习评分结果写入情景记忆（供弱点分析和 memory_search 使用）。"""
+        """将练习评分结果写入情景记忆（供弱点分析和 memory_search 使用）。
+
+        question: 历史中最近一条 assistant 消息（即被评分的题目），未找到时为 None
+        """
         try:
             import re as _re
             from memory.manager import get_memory_manager
 
-            # 提取题目（历史中最近一条 assistant 消息）
-            question = "（未能提取题目）"
-            for msg in reversed(history[-20:]):
-                if msg.get("role") == "assistant":
-                    question = msg.get("content", "")[:300]
-                    break
+            question = question[:300] if question is not None else "（未能提取题目）"
 
             # 从评分回复中提取数字得分（支持：得分：80、80/100、80分 等格式）
             score = 60.0  # 默认中等分，触发 mistake 判断
@@ -387,38 +646,72 @@ class OrchestrationRunner:
             if mistake_tags and is_mistake:
                 mgr.update_weak_points(course_name, mistake_tags)
             mgr.record_practice_result(course_name, score, is_mistake)
-            print(f"[Memory] 练习{'错题' if is_mistake else '结果'}已记录，得分={score:.0f}")
-        except Exception as _e:
-            print(f"[Memory] 练习记忆写入失败（不影响评分）: {_e}")
+            logger.info("[Memory] 练习%s已记录，得分=%.0f", "错题" if is_mistake else "结果", score)
+        except Exception:
+            logger.warning("[Memory] 练习记忆写入失败（不影响评分）", exc_info=True)
 
     def _is_exam_grading(self, text: str) -> bool:
         """判断考试模式回复是否为批改阶段。"""
-        keywords = ["批改报告", "逐题详批", "评分总表", "总得分", "总分", "考后建议", "薄弱知识点"]
-        return sum(1 for kw in keywords if kw in text) >= 2
+        return _has_two_keywords(_EXAM_GRADING_RE, text)
+
+    def _save_exam_to_memory(self, course_name: str, response_text: str) -> None:
+        """将考试批改结果写入情景记忆，并把薄弱知识点合并进用户画像。"""
+        try:
+            from memory.manager import get_memory_manager
+
+            # 总分：兼容 "总得分：85 / 100 分"、"**总得分**：85" 等格式
+            score = None
+            m = re.search(r"总得分\**\s*[：:＝=]\s*\**\s*([0-9]+(?:\.[0-9]+)?)", response_text)
+            if m:
+                score = float(m.group(1))
 
-    def _save_practice_record(self, course_name: str, user_message: str, history: list, response_text: str) -> str:
+            # 薄弱知识点：取标题后的列表项或同行以顿号/逗号分隔的内容
+            weak_points: list[str] = []
+            wm = re.search(r"薄弱知识点\**\s*[：:]\**(.*?)(?:\n\s*\n|\n\s*\*\*|\n-{3,}|$)",
+                           response_text, re.S)
+            if wm:
+                for item in re.split(r"[\n,，、；;]", wm.group(1)):
+                    item = item.strip().lstrip("-*•· ").strip()
+                    if item and item != "…":
+                        weak_points.append(item)
+                weak_points = weak_points[:5]
+
+            content = "考试批改完成"
+            if score is not None:
+                content += f"\n总得分: {score:.0f}"
+            if weak_points:
+                content += f"\n薄弱知识点: {', '.join(weak_points)}"
+
+            mgr = get_memory_manager()
+            mgr.save_episode(
+                course_name=course_name,
+                event_type="exam",
+                content=content,
+                importance=0.8,
+                metadata={"score": score, "weak_points": weak_points},
+            )
+            if weak_points:
+                mgr.update_weak_points(course_name, weak_points)
+        except Exception:
+            logger.warning("[Memory] 考试记忆写入失败（不影响批改）", exc_info=True)
+
+    def _save_practice_record(self, course_name: str, user_message: str, quiz_content: Optional[str],
+                              response_text: str) -> str:
         """保存练习题记录（题目、用户答案、评分解析），返回相对路径。
         user_message: 当前用户提交的答案（直接传入，不从 history 提取）
-        history: 当前消息之前的历史（用于提取题目内容）
+        quiz_content: 历史中最近一条 assistant 消息（题目内容），未找到时为 None
         """
         workspace_path = self.get_workspace_path(course_name)
         practices_dir = os.path.join(workspace_path, "practices")
-        os.makedirs(practices_dir, exist_ok=True)
 
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        now = datetime.now()
+        timestamp = now.strftime(_FILE_TS_FORMAT)
         filename = f"练习记录_{timestamp}.md"
         filepath = os.path.join(practices_dir, filename)
 
-        # 从历史中提取最近一条 assistant 消息作为题目内容
-        quiz_content = None
-        for msg in reversed(history[-20:]):
-            if msg.get("role") == "assistant":
-                quiz_content = msg.get("content", "")
-                break
-
         md = f"""# 练习记录
 
-**时间**：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+**时间**：{now.strftime(_DISPLAY_TS_FORMAT)}
 **课程**：{course_name}
 
 ---
@@ -439,35 +732,26 @@ class OrchestrationRunner:
 
 {response_text}
 """
-        with open(filepath, "w", encoding="utf-8") as f:
-            f.write(md)
+        _submit_write(filepath, md)
         return f"practices/{filename}"
 
-    def _save_exam_record(self, course_name: str, user_message: str, history: list, response_text: str) -> str:
+    def _save_exam_record(self, course_name: str, user_message: str, exam_paper: Optional[str],
+                          response_text: str) -> str:
         """保存考试完整记录（试卷、用户答案、批改报告），返回相对路径。
         user_message: 用户提交的全部答案（直接传入）
-        history: 当前消息之前的历史（用于提取试卷内容）
+        exam_paper: 历史中最近一条含试卷内容的 assistant 消息，未找到时为 None
         """
         workspace_path = self.get_workspace_path(course_name)
         exams_dir = os.path.join(workspace_path, "exams")
-        os.makedirs(exams_dir, exist_ok=True)
 
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        now = datetime.now()
+        timestamp = now.strftime(_FILE_TS_FORMAT)
         filename = f"考试记录_{timestamp}.md"
         filepath = os.path.join(exams_dir, filename)
 
-        # 从历史中提取包含试卷内容的最近 assistant 消息
-        exam_paper = None
-        for msg in reversed(history[-30:]):
-            if msg.get("role") == "assistant":
-                content = msg.get("content", "")
-                if any(kw in content for kw in ["模拟考试试卷", "第一部分", "第二部分"]):
-                    exam_paper = content
-                    break
-
         md = f"""# 考试记录
 
-**时间**：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+**时间**：{now.strftime(_DISPLAY_TS_FORMAT)}
 **课程**：{course_name}
 
 ---
@@ -488,8 +772,7 @@ class OrchestrationRunner:
 
 {response_text}
 """
-        with open(filepath, "w", encoding="utf-8") as f:
-            f.write(md)
+        _submit_write(filepath, md)
         return f"exams/{filename}"
 
     def run(
@@ -503,16 +786,16 @@ class OrchestrationRunner:
         """Main orchestration entry point."""
         if history is None:
             history = []
-        # Generate plan
-        plan = self.router.plan(user_message, mode, course_name)
+        # Generate plan（与检索并行）
+        plan, retrieved = self.plan_and_retrieve(course_name, mode, user_message, history)
         
         # Execute based on mode
         if mode == "learn":
-            response = self.run_learn_mode(course_name, user_message, plan, history)
+            response = self.run_learn_mode(course_name, user_message, plan, history, retrieved)
         elif mode == "practice":
-            response = self.run_practice_mode(course_name, user_message, plan, state, history)
+            response = self.run_practice_mode(course_name, user_message, plan, state, history, retrieved)
         elif mode == "exam":
-            response = self.run_exam_mode(course_name, user_message, plan, history)
+            response = self.run_exam_mode(course_name, user_message, plan, history, retrieved)
         else:
             response = ChatMessage(
                 role="assistant",
@@ -528,7 +811,8 @@ class OrchestrationRunner:
         course_name: str,
         user_message: str,
         plan: Plan,
-        history: List[Dict[str, str]] = None
+        history: List[Dict[str, str]] = None,
+        retrieved: Optional[Retrieved] = None,
     ):
         """流式学习模式：先检索上下文，再流式输出导师回答。
 
@@ -541,13 +825,8 @@ class OrchestrationRunner:
         context = ""
         citations_dicts = []
         if plan.need_rag:
-            retriever = self.load_retriever(course_name)
-            if retriever:
-                chunks = retriever.retrieve(user_message)
-                context = retriever.format_context(chunks)
-                citations_dicts = [c.model_dump() for c in chunks]
-            else:
-                context = "（未找到相关教材，请先上传课程资料）"
+            context, chunks = retrieved or self.retrieve_context(course_name, user_message)
+            citations_dicts = _CHUNK_LIST_ADAPTER.dump_python(chunks)
 
         # 先发送 citations 事件（前端按 __citations__ key 识别，不会渲染为文本）
         if citations_dicts:
@@ -555,13 +834,14 @@ class OrchestrationRunner:
 
         workspace_path = self.get_workspace_path(course_name)
         notes_dir = os.path.abspath(os.path.join(workspace_path, "notes"))
-        MCPTools._context = {"notes_dir": notes_dir}
+        ctx = contextvars.copy_context()
+        ctx.run(MCPTools._context_var.set, {"notes_dir": notes_dir})
 
-        yield from self.tutor.teach_stream(
+        yield from _iterate_in_context(ctx, self.tutor.teach_stream(
             user_message, course_name, context,
             allowed_tools=plan.allowed_tools,
             history=history
-        )
+        ))
 
         # 流式输出完成后写入情景记忆（异步失败不影响主流程）
         try:
@@ -579,8 +859,8 @@ class OrchestrationRunner:
                 metadata={"doc_ids": doc_ids},
             )
             mgr.increment_qa_count(course_name)
-        except Exception as _mem_err:
-            print(f"[Memory] 写入情景记忆失败（不影响输出）: {_mem_err}")
+        except Exception:
+            logger.warning("[Memory] 写入情景记忆失败（不影响输出）", exc_info=True)
 
     def run_stream(
         self,
@@ -593,14 +873,14 @@ class OrchestrationRunner:
         """主流式入口，learn 模式真正流式，其他模式一次性输出。"""
         if history is None:
             history = []
-        plan = self.router.plan(user_message, mode, course_name)
+        plan, retrieved = self.plan_and_retrieve(course_name, mode, user_message, history)
 
         if mode == "learn":
-            yield from self.run_learn_mode_stream(course_name, user_message, plan, history)
+            yield from self.run_learn_mode_stream(course_name, user_message, plan, history, retrieved)
         elif mode == "practice":
-            yield from self.run_practice_mode_stream(course_name, user_message, plan, history)
+            yield from self.run_practice_mode_stream(course_name, user_message, plan, history, retrieved)
         elif mode == "exam":
-            yield from self.run_exam_mode_stream(course_name, user_message, plan, history)
+            yield from self.run_exam_mode_stream(course_name, user_message, plan, history, retrieved)
         else:
             response, _ = self.run(course_name, mode, user_message, state, history)
             yield response.content
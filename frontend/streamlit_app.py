@@ -1,13 +1,48 @@
 """Streamlit frontend for Course Learning Agent."""
 import re
 import streamlit as st
+import streamlit.components.v1 as components
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from urllib3.fields import RequestField
+import hashlib
+import io
+import orjson
 import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+# 每次 rerun 都会对全部历史消息执行，模式在导入时编译一次
+_RE_MERMAID = re.compile(r"```mermaid\s*(.*?)```", re.DOTALL)
+# 思维导图下载文件名中的非法字符
+_SAFE_TITLE_RE = re.compile(r"[^\w\-]")
+
+
+def _replace_delimited(text: str, opener: str, closer: str, wrap: str) -> str:
+    """把 opener...closer 之间的内容去掉首尾空白后用 wrap 包裹；用 str.find 线性扫描，不回溯。"""
+    parts = []
+    i = 0
+    while True:
+        start = text.find(opener, i)
+        if start < 0:
+            break
+        end = text.find(closer, start + 2)
+        if end < 0:
+            break
+        parts.append(text[i:start])
+        parts.append(wrap + text[start + 2:end].strip() + wrap)
+        i = end + 2
+    if not parts:
+        return text
+    parts.append(text[i:])
+    return "".join(parts)
 
-def fix_latex(text: str) -> str:
+
+def _fix_latex_impl(text: str) -> str:
     """将 LLM 输出的 LaTeX 定界符转换为 Streamlit KaTeX 可识别的格式。
     \\[...\\]  →  $$...$$  （块公式）
     \\(...\\)  →  $...$    （行内公式）
@@ -15,101 +50,74 @@ def fix_latex(text: str) -> str:
     if not text:
         return text
     # 块公式：\[ ... \]  →  $$...$$
-    text = re.sub(r'\\\[\s*(.*?)\s*\\\]', r'$$\1$$', text, flags=re.DOTALL)
+    if "\\[" in text:
+        text = _replace_delimited(text, "\\[", "\\]", "$$")
     # 行内公式：\( ... \)  →  $...$
-    text = re.sub(r'\\\(\s*(.*?)\s*\\\)', r'$\1$', text, flags=re.DOTALL)
+    if "\\(" in text:
+        text = _replace_delimited(text, "\\(", "\\)", "$")
     return text
 
 
+@st.cache_data(max_entries=1024, show_spinner=False)
+def fix_latex(text: str) -> str:
+    """按消息内容缓存 _fix_latex_impl 的结果：rerun 时历史消息直接命中缓存。"""
+    return _fix_latex_impl(text)
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
 def extract_mermaid_blocks(text: str):
-    """从回复文本中提取 ```mermaid``` 代码块，返回 (cleaned_text, [code_str, ...])。"""
+    """从回复文本中提取 ```mermaid``` 代码块，返回 (cleaned_text, (code_str, ...))。"""
+    # 多数回复不含思维导图，字面量不存在时跳过正则
+    if "```mermaid" not in text:
+        return text, ()
     blocks: list[str] = []
 
     def _repl(m: re.Match) -> str:
         blocks.append(m.group(1).strip())
         return "\n> 📊 *[思维导图已在下方渲染]*\n"
 
-    cleaned = re.sub(r"```mermaid\s*(.*?)```", _repl, text, flags=re.DOTALL)
-    return cleaned, blocks
-
-
-def render_mermaid(mermaid_code: str, idx: int = 0, height: int = 520) -> None:
-    """使用 Mermaid CDN + components.html 渲染思维导图，并提供 SVG/PNG 下载按钮。"""
-    import streamlit.components.v1 as components
-
-    svg_id = f"mm{idx}"
-    html_code = f"""<!DOCTYPE html>
-<html><head>
-<style>
-  body{{margin:0;padding:8px;background:#fff;font-family:sans-serif;}}
-  .tb{{display:flex;gap:8px;margin-bottom:8px;flex-wrap:wrap;}}
-  button{{padding:5px 14px;border:1px solid #ced4da;border-radius:4px;cursor:pointer;
-          background:#f8f9fa;font-size:13px;}}
-  button:hover{{background:#e2e6ea;}}
-  #mc{{overflow:auto;text-align:center;}}
-  .mermaid{{display:inline-block;}}
-</style>
-</head><body>
-<div class="tb">
-  <button onclick="dlSVG()">⬇ 下载 SVG</button>
-  <button onclick="dlPNG()">🖼 下载 PNG</button>
-</div>
-<div id="mc"><div class="mermaid" id="{svg_id}">{mermaid_code}</div></div>
-<script type="module">
-  import mermaid from 'https://cdn.jsdelivr.net/npm/mermaid@10/dist/mermaid.esm.min.mjs';
-  mermaid.initialize({{startOnLoad:true,theme:'default',securityLevel:'loose'}});
-</script>
-<script>
-function dlSVG(){{
-  var el=document.querySelector('#{svg_id} svg');
-  if(!el){{alert('图表尚未渲染，请稍等片刻');return;}}
-  var d=new XMLSerializer().serializeToString(el);
-  var b=new Blob([d],{{type:'image/svg+xml;charset=utf-8'}});
-  var u=URL.createObjectURL(b);
-  var a=document.createElement('a');a.href=u;a.download='mindmap.svg';a.click();
-  URL.revokeObjectURL(u);
-}}
-function dlPNG(){{
-  var el=document.querySelector('#{svg_id} svg');
-  if(!el){{alert('图表尚未渲染，请稍等片刻');return;}}
-  // \u4ece viewBox \u8bfb\u53d6\u81ea\u7136\u5206\u8fa8\u7387\uff08Mermaid \u8f93\u51fa\u7684\u771f\u5b9e SVG \u5c3a\u5bf8\uff09
-  var natW=0,natH=0;
-  var vb=el.getAttribute('viewBox');
-  if(vb){{
-    var pts=vb.trim().split(/[\\s,]+/);
-    if(pts.length>=4){{natW=parseFloat(pts[2]);natH=parseFloat(pts[3]);}}
-  }}
-  if(!natW){{natW=parseFloat(el.getAttribute('width'))||1600;}}
-  if(!natH){{natH=parseFloat(el.getAttribute('height'))||900;}}
-  // 3\u00d7 \u8d85\u91c7\u6837\uff0c\u8f93\u51fa\u9ad8\u6e05 PNG
-  var scale=3;
-  var c=document.createElement('canvas');
-  c.width=Math.round(natW*scale);
-  c.height=Math.round(natH*scale);
-  var ctx=c.getContext('2d');
-  // \u514b\u9686 SVG \u5e76\u663e\u5f0f\u8bbe\u7f6e width/height \u4ee5\u786e\u4fdd\u6b63\u786e\u62c9\u4f38
-  var clone=el.cloneNode(true);
-  clone.setAttribute('width',natW);
-  clone.setAttribute('height',natH);
-  var sd=new XMLSerializer().serializeToString(clone);
-  var img=new Image();
-  img.onload=function(){{
-    ctx.fillStyle='white';ctx.fillRect(0,0,c.width,c.height);
-    ctx.scale(scale,scale);
-    ctx.drawImage(img,0,0,natW,natH);
-    var a=document.createElement('a');a.href=c.toDataURL('image/png',1.0);
-    a.download='mindmap.png';a.click();
-  }};
-  img.src='data:image/svg+xml;base64,'+btoa(unescape(encodeURIComponent(sd)));
-}}
-</script>
-</body></html>"""
-    components.html(html_code, height=height, scrolling=True)
+    cleaned = _RE_MERMAID.sub(_repl, text)
+    return cleaned, tuple(blocks)
+
+
+# 思维导图渲染组件：静态页面由 Streamlit 按文件提供（浏览器可缓存），每次只传 code/id 参数
+_mermaid_component = components.declare_component(
+    "mermaid_renderer",
+    path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "mermaid_component"),
+)
+
+
+def _mm_id(code: str) -> str:
+    """思维导图的稳定 id（内容哈希），用作 DOM 元素 id 与控件 key。"""
+    return hashlib.blake2b(code.encode("utf-8"), digest_size=6).hexdigest()
+
+
+def render_mermaid(mermaid_code: str, idx: str = "0", height: int = 520, key: str = None) -> None:
+    """使用 Mermaid 组件渲染思维导图，并提供 SVG/PNG 下载按钮。"""
+    _mermaid_component(code=mermaid_code, id=idx, height=height, key=key or f"mm_{idx}", default=None)
 
 
 # API endpoint
 API_BASE = os.getenv("API_BASE", "http://localhost:8000")
 
+
+@st.cache_resource
+def _get_session() -> requests.Session:
+    """进程内共享的 HTTP 会话：复用到后端的 keep-alive 连接。
+
+    Streamlit 每次交互都会重新执行整个脚本，用 cache_resource 保证只创建一次。
+    """
+    session = requests.Session()
+    session.headers["User-Agent"] = "course-agent-frontend"
+    # 所有用户会话共用这一个池：并发的流式对话各自长时间占用一条连接
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=20, max_retries=1)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_SESSION = _get_session()
+
 # ── 模式主题色 ───────────────────────────────────────────────────────────────
 MODE_THEME = {
     "learn":    {"bg": "#EBF5FB", "accent": "#2471A3", "pill": "#D6EAF8", "label": "📖 学习模式"},
@@ -117,10 +125,26 @@ MODE_THEME = {
     "exam":     {"bg": "#FEF9E7", "accent": "#9A7D0A", "pill": "#FCF3CF", "label": "📝 考试模式"},
 }
 
-def inject_mode_css(mode: str) -> None:
-    """注入全局样式（不改主背景色，保持灰白协调）。"""
+# 对话区模式指示条：(图标, 名称, 提示)
+_MODE_BAR_RAW = {
+    "learn":    ("📖", "学习模式", "提问知识点 · 生成思维导图 · 保存笔记"),
+    "practice": ("✍️", "练习模式", "指定题型和知识点 · 提交答案后自动评分"),
+    "exam":     ("📝", "考试模式", "配置考试 → 收到试卷 → 一次性提交全部答案"),
+}
+
+# 顶栏胶囊与指示条的 HTML 片段按模式预先拼好，渲染时直接输出
+_MODE_PILL_HTML = {m: f'<span class="mode-pill">{c["label"]}</span>' for m, c in MODE_THEME.items()}
+_MODE_BAR_HTML = {
+    m: f'<div class="mode-bar">{icon} <span>{label}</span>'
+       f'<span style="font-weight:400;font-size:0.82rem;opacity:0.8;margin-left:8px">· {tip}</span></div>'
+    for m, (icon, label, tip) in _MODE_BAR_RAW.items()
+}
+
+@st.cache_data(show_spinner=False)
+def _mode_css(mode: str) -> str:
+    """按模式生成样式表；脚本每次 rerun 都会重新执行，用 cache_data 让每种模式只格式化一次。"""
     c = MODE_THEME.get(mode, MODE_THEME["learn"])
-    st.markdown(f"""<style>
+    return f"""<style>
 /* 侧边栏保持浅灰 */
 [data-testid="stSidebar"] {{
     background-color: #F4F6F8 !important;
@@ -152,7 +176,15 @@ def inject_mode_css(mode: str) -> None:
     padding:22px 24px; line-height:1.75; margin-bottom:12px;
 }}
 .help-section h3 {{ color:{c["accent"]}; margin-top:1rem; }}
-</style>""", unsafe_allow_html=True)
+</style>"""
+
+
+def inject_mode_css(mode: str) -> None:
+    """注入全局样式（不改主背景色，保持灰白协调）。
+
+    每次 rerun 都必须重新输出：Streamlit 会移除本轮未输出的元素，跳过注入会让样式消失。
+    """
+    st.markdown(_mode_css(mode), unsafe_allow_html=True)
 
 # ── 帮助面板内容 ──────────────────────────────────────────────────────────────
 HELP_CONTENT = """
@@ -218,14 +250,24 @@ if "workspaces" not in st.session_state:
     st.session_state.workspaces = []
 if "show_help" not in st.session_state:
     st.session_state.show_help = False
+if "files_nonce" not in st.session_state:
+    st.session_state.files_nonce = 0
+if "ws_nonce" not in st.session_state:
+    st.session_state.ws_nonce = 0
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _get_workspaces(nonce: int):
+    """获取课程列表（30 秒缓存；请求失败时抛出异常，不缓存失败结果）。"""
+    response = _SESSION.get(f"{API_BASE}/workspaces")
+    response.raise_for_status()
+    return response.json()
 
 
 def load_workspaces():
     """Load available workspaces."""
     try:
-        response = requests.get(f"{API_BASE}/workspaces")
-        if response.status_code == 200:
-            st.session_state.workspaces = response.json()
+        st.session_state.workspaces = _get_workspaces(st.session_state.ws_nonce)
     except Exception as e:
         st.error(f"加载课程失败: {e}")
 
@@ -233,12 +275,15 @@ def load_workspaces():
 def create_workspace(course_name: str, subject: str):
     """Create a new workspace."""
     try:
-        response = requests.post(
+        response = _SESSION.post(
             f"{API_BASE}/workspaces",
             json={"course_name": course_name, "subject": subject}
         )
         if response.status_code == 200:
             st.success(f"课程 '{course_name}' 创建成功！")
+            # 课程列表变化：清掉所有会话共享的缓存，本会话换新 nonce 立即重新拉取
+            _get_workspaces.clear()
+            st.session_state.ws_nonce += 1
             load_workspaces()
             return True
         else:
@@ -252,13 +297,54 @@ def create_workspace(course_name: str, subject: str):
     return False
 
 
+class _MultipartFileBody:
+    """单文件 multipart/form-data 请求体，发送时按块读取文件。
+
+    requests 的 files= 会先在内存里拼出完整请求体；UploadedFile 本身已占一份内存，
+    大教材上传时峰值翻倍。这里只预先生成头尾两段，文件内容按块读出。
+    """
+
+    _CHUNK_SIZE = 1 << 20
+
+    def __init__(self, field: str, file):
+        boundary = uuid.uuid4().hex
+        rf = RequestField(field, b"", filename=file.name)
+        rf.make_multipart(content_type=file.type or "application/octet-stream")
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self._head = f"--{boundary}\r\n{rf.render_headers()}".encode("utf-8")
+        self._tail = f"\r\n--{boundary}--\r\n".encode("ascii")
+        self._file = file
+        self._file.seek(0)
+        self._size = file.size
+        self._stage = 0
+
+    def __len__(self) -> int:
+        return len(self._head) + self._size + len(self._tail)
+
+    def read(self, size: int = -1) -> bytes:
+        if self._stage == 0:
+            self._stage = 1
+            return self._head
+        if self._stage == 1:
+            data = self._file.read(self._CHUNK_SIZE if size is None or size < 0 else size)
+            if data:
+                return data
+            self._stage = 2
+        if self._stage == 2:
+            self._stage = 3
+            return self._tail
+        return b""
+
+
 def upload_file(course_name: str, file):
     """Upload a file to workspace."""
     try:
-        files = {"file": (file.name, file, file.type)}
-        response = requests.post(
+        body = _MultipartFileBody("file", file)
+        response = _SESSION.post(
             f"{API_BASE}/workspaces/{course_name}/upload",
-            files=files
+            data=body,
+            headers={"Content-Type": body.content_type},
+            timeout=300,
         )
         if response.status_code == 200:
             return True
@@ -267,49 +353,130 @@ def upload_file(course_name: str, file):
     return False
 
 
+_EMPTY_FILES = {"files": [], "index_built": False, "index_mtime": None}
+
+
+@st.cache_data(ttl=5, show_spinner=False)
+def _fetch_files(course: str, nonce: int):
+    """获取课程文件列表与索引状态（短 TTL 缓存，nonce 变化时强制刷新）。"""
+    try:
+        resp = _SESSION.get(f"{API_BASE}/workspaces/{course}/files", timeout=5)
+        return resp.json() if resp.status_code == 200 else _EMPTY_FILES
+    except Exception:
+        return _EMPTY_FILES
+
+
+@st.cache_resource
+def _load_pool() -> ThreadPoolExecutor:
+    """侧边栏并发加载用的线程池（与 HTTP 会话一样，跨 rerun 只创建一次）。"""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="sidebar-load")
+
+
+def _submit_with_ctx(fn, *args):
+    """在线程池中执行 fn，线程挂上当前脚本上下文，缓存函数可正常使用。"""
+    ctx = get_script_run_ctx()
+
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
+
+    return _load_pool().submit(run)
+
+
+def _invalidate_files():
+    """上传/删除/构建索引后调用，使下一次 _fetch_files 重新请求后端。"""
+    st.session_state.files_nonce = st.session_state.get("files_nonce", 0) + 1
+
+
+# 前端轮询索引任务的最长等待秒数；超时后不再阻塞页面，任务仍在后台继续
+INDEX_POLL_TIMEOUT = int(os.getenv("INDEX_POLL_TIMEOUT", "1800"))
+
+
 def build_index(course_name: str):
-    """Build RAG index for workspace."""
+    """Build RAG index for workspace (submit background job and poll until finished)."""
     try:
-        response = requests.post(
+        response = _SESSION.post(
             f"{API_BASE}/workspaces/{course_name}/build-index",
-            timeout=300  # 最长等待5分钟（首次需下载嵌入模型）
+            timeout=30
         )
-        if response.status_code == 200:
-            data = response.json()
-            st.success(f"索引构建成功！共 {data['num_chunks']} 个文本块")
-            return True
-        else:
+        if response.status_code != 202:
             try:
                 detail = response.json().get("detail", response.text)
             except Exception:
                 detail = response.text or f"HTTP {response.status_code}"
             st.error(f"构建失败: {detail}")
+            return False
+
+        job_id = response.json()["job_id"]
+        progress = st.progress(0.0, text="索引任务排队中…")
+        deadline = time.monotonic() + INDEX_POLL_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(1)
+            poll = _SESSION.get(
+                f"{API_BASE}/workspaces/{course_name}/jobs/{job_id}", timeout=10
+            )
+            if poll.status_code == 404:
+                st.error("构建任务已丢失（后端可能已重启），请重新构建索引")
+                return False
+            if poll.status_code != 200:
+                try:
+                    detail = poll.json().get("detail", poll.text)
+                except Exception:
+                    detail = poll.text or f"HTTP {poll.status_code}"
+                st.error(f"查询构建进度失败: {detail}")
+                return False
+            job = poll.json()
+            total = job.get("total") or 1
+            eta = job.get("eta")
+            eta_str = f"，预计剩余 {eta:.0f} 秒" if eta else ""
+            progress.progress(
+                min(job.get("processed", 0) / total, 1.0),
+                text=f"已解析 {job.get('processed', 0)}/{total} 个文件{eta_str}",
+            )
+            if job["status"] == "done":
+                st.success(f"索引构建成功！共 {job['num_chunks']} 个文本块")
+                return True
+            if job["status"] == "failed":
+                st.error(f"构建失败: {job.get('error')}")
+                return False
+        st.warning(f"等待超过 {INDEX_POLL_TIMEOUT} 秒仍未完成，任务会在后台继续，请稍后刷新查看索引状态")
     except requests.exceptions.Timeout:
-        st.error("构建超时，请检查后端是否在下载嵌入模型，稍后重试")
+        st.error("请求超时，请检查后端是否正常运行，稍后重试")
     except Exception as e:
         st.error(f"构建索引失败: {e}")
     return False
 
 
+# 对话接口的请求体由 orjson 预先序列化为 bytes，需显式声明类型
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def _build_history_payload() -> list[dict]:
+    """取当前消息之前的最多 20 条历史，只保留 role 和 content 字段。
+
+    [-21:-1] 排除最后一条刚 append 的用户消息，避免重复。
+    """
+    hist = st.session_state.chat_history
+    return [{"role": m["role"], "content": m["content"]} for m in hist[-21:-1]]
+
+
 def send_message(course_name: str, mode: str, message: str):
     """Send a chat message with history."""
     try:
-        # 取当前消息之前的最多 20 条历史（[-21:-1] 排除最后一条刚 append 的用户消息，避免重复）
-        history = st.session_state.chat_history[-21:-1] if st.session_state.chat_history else []
-        # 只保留 role 和 content 字段
-        history_payload = [{"role": m["role"], "content": m["content"]} for m in history]
-        response = requests.post(
+        history_payload = _build_history_payload()
+        response = _SESSION.post(
             f"{API_BASE}/chat",
-            json={
+            data=orjson.dumps({
                 "course_name": course_name,
                 "mode": mode,
                 "message": message,
                 "history": history_payload
-            },
+            }),
+            headers=_JSON_HEADERS,
             timeout=120
         )
         if response.status_code == 200:
-            return response.json()
+            return orjson.loads(response.content)
         else:
             try:
                 detail = response.json().get("detail", response.text)
@@ -323,22 +490,33 @@ def send_message(course_name: str, mode: str, message: str):
     return None
 
 
+def _iter_sse_data(resp):
+    """按 SSE 事件（空行分隔）切分响应字节流，产出每个事件 data: 之后的文本。
+
+    网络块到达后在 bytes 上一次性切分，每个事件只解码一次，不逐行构造字符串。
+    """
+    buf = b""
+    for chunk in resp.iter_content(chunk_size=None):
+        buf += chunk
+        *events, buf = buf.split(b"\n\n")
+        for event in events:
+            if event.startswith(b"data: "):
+                yield event[6:].decode("utf-8")
+
+
 def stream_chat(course_name: str, mode: str, message: str):
     """流式发送消息，返回文本 chunk 生成器（供 st.write_stream 使用）。"""
-    import json as _json
-    # 取当前消息之前的最多 20 条历史（[-21:-1] 排除最后一条刚 append 的用户消息，避免重复）
-    history = st.session_state.chat_history[-21:-1] if st.session_state.chat_history else []
-    history_payload = [{"role": m["role"], "content": m["content"]} for m in history]
     payload = {
         "course_name": course_name,
         "mode": mode,
         "message": message,
-        "history": history_payload,
+        "history": _build_history_payload(),
     }
     try:
-        with requests.post(
+        with _SESSION.post(
             f"{API_BASE}/chat/stream",
-            json=payload,
+            data=orjson.dumps(payload),
+            headers=_JSON_HEADERS,
             stream=True,
             timeout=180,
         ) as resp:
@@ -349,24 +527,79 @@ def stream_chat(course_name: str, mode: str, message: str):
                     detail = resp.text or f"HTTP {resp.status_code}"
                 yield f"（请求失败：{detail}）"
                 return
-            for raw_line in resp.iter_lines():
-                if raw_line:
-                    line = raw_line.decode("utf-8") if isinstance(raw_line, bytes) else raw_line
-                    if line.startswith("data: "):
-                        data = line[6:]
-                        if data == "[DONE]":
-                            break
-                        # JSON 解码，还原换行符等特殊字符
-                        try:
-                            yield _json.loads(data)
-                        except _json.JSONDecodeError:
-                            yield data
+            for data in _iter_sse_data(resp):
+                if data == "[DONE]":
+                    break
+                # 不含转义的 JSON 字符串直接去掉引号，省去 json 解析
+                if len(data) >= 2 and data[0] == '"' and data[-1] == '"' and "\\" not in data:
+                    yield data[1:-1]
+                    continue
+                # JSON 解码，还原换行符等特殊字符
+                try:
+                    yield orjson.loads(data)
+                except orjson.JSONDecodeError:
+                    yield data
     except requests.exceptions.Timeout:
         yield "（请求超时，请稍后重试）"
     except Exception as e:
         yield f"（流式输出失败：{e}）"
 
 
+# 旧版 Streamlit 没有 fragment，退化为普通函数
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda f: f)
+
+
+@_fragment
+def _render_chat_history(history: list) -> None:
+    """渲染对话历史。
+
+    作为 fragment 时，历史区内的控件（下载按钮等）只重跑这一段而不是整个脚本；
+    正文的定界符转换由 fix_latex 的缓存命中，不会逐条重复计算。
+    """
+    for h_idx, msg in enumerate(history):
+        with st.chat_message(msg["role"]):
+            # 助手消息入库时已转换定界符；用户消息转换结果存于 content_rendered
+            st.markdown(msg.get("content_rendered", msg["content"]))
+            
+            # Display citations if available
+            if msg.get("citations"):
+                with st.expander(f"📑 查看引用来源（共 {len(msg['citations'])} 条）"):
+                    for i, citation in enumerate(msg["citations"]):
+                        page_str = f"  第 {citation['page']} 页" if citation.get("page") else ""
+                        score_str = f"  相关度 {citation['score']:.2f}" if citation.get("score") is not None else ""
+                        st.markdown(
+                            f"**[来源{i+1}]** `{citation['doc_id']}`{page_str}{score_str}"
+                        )
+                        text = citation["text"]
+                        preview = text[:300]
+                        if "\n" in preview:
+                            preview = preview.replace("\n", " ")
+                        preview = preview.strip()
+                        if len(text) > 300:
+                            preview += "…"
+                        st.caption(preview)
+                        if i < len(msg["citations"]) - 1:
+                            st.divider()
+            
+            # Display tool calls if available
+            if msg.get("tool_calls"):
+                with st.expander("🔧 工具调用"):
+                    for tool_call in msg["tool_calls"]:
+                        st.json(tool_call)
+
+            # Render mermaid blocks if available
+            for m_idx, mb in enumerate(msg.get("mermaid_blocks") or []):
+                render_mermaid(mb["code"], idx=mb["id"], height=520, key=f"mm_{mb['id']}_{h_idx}_{m_idx}")
+                with st.expander("📄 下载 Mermaid 源码"):
+                    st.download_button(
+                        label="⬇ 下载 .md 文件",
+                        data=f"```mermaid\n{mb['code']}\n```",
+                        file_name=f"{mb['safe_title']}.md",
+                        mime="text/markdown",
+                        key=f"dl_md_{mb['id']}_{h_idx}_{m_idx}",
+                    )
+
+
 # Main UI
 st.markdown("""
 <div style="display:flex; align-items:center; justify-content:space-between; margin-bottom:0.2rem;">
@@ -400,7 +633,14 @@ with st.sidebar:
     st.header("⚙️ 设置")
     
     # Load workspaces
+    files_prefetch = None
     if st.button("🔄 刷新课程列表"):
+        # 当前课程的文件列表与课程列表同时请求，两次网络往返重叠
+        if st.session_state.current_course:
+            files_key = (st.session_state.current_course, st.session_state.files_nonce)
+            files_prefetch = (files_key, _submit_with_ctx(_fetch_files, *files_key))
+        # 显式刷新必须绕过 30 秒缓存：换新 nonce 强制重新请求
+        st.session_state.ws_nonce += 1
         load_workspaces()
     
     # Create new workspace
@@ -461,16 +701,17 @@ with st.sidebar:
             )
             if uploaded_file and st.button("⬆ 上传"):
                 if upload_file(st.session_state.current_course, uploaded_file):
+                    _invalidate_files()
                     st.success(f"✅ {uploaded_file.name} 上传成功")
                     st.rerun()
 
         # ── 文件列表 ─────────────────────────────────
         course = st.session_state.current_course
-        try:
-            resp = requests.get(f"{API_BASE}/workspaces/{course}/files", timeout=5)
-            fdata = resp.json() if resp.status_code == 200 else {"files": [], "index_built": False, "index_mtime": None}
-        except Exception:
-            fdata = {"files": [], "index_built": False, "index_mtime": None}
+        files_key = (course, st.session_state.files_nonce)
+        if files_prefetch is not None and files_prefetch[0] == files_key:
+            fdata = files_prefetch[1].result()
+        else:
+            fdata = _fetch_files(*files_key)
 
         files = fdata.get("files", [])
         index_built = fdata.get("index_built", False)
@@ -488,9 +729,10 @@ with st.sidebar:
                         safe_key = re.sub(r"\W", "_", f["name"])
                         if st.button("🗑", key=f"del_file_{safe_key}", help=f"删除 {f['name']}"):
                             try:
-                                dr = requests.delete(
+                                dr = _SESSION.delete(
                                     f"{API_BASE}/workspaces/{course}/files/{f['name']}", timeout=10)
                                 if dr.status_code == 200:
+                                    _invalidate_files()
                                     st.success(f"已删除 {f['name']}")
                                     st.rerun()
                                 else:
@@ -512,12 +754,14 @@ with st.sidebar:
                 if st.button("🔨 重建索引", use_container_width=True):
                     with st.spinner("构建中…"):
                         build_index(course)
+                    _invalidate_files()
                     st.rerun()
             with col_d:
                 if st.button("🗑 删除索引", use_container_width=True):
                     try:
-                        dr = requests.delete(f"{API_BASE}/workspaces/{course}/index", timeout=10)
+                        dr = _SESSION.delete(f"{API_BASE}/workspaces/{course}/index", timeout=10)
                         if dr.status_code == 200:
+                            _invalidate_files()
                             st.warning("索引已删除")
                             st.rerun()
                         else:
@@ -529,6 +773,7 @@ with st.sidebar:
             if st.button("🔨 构建索引", use_container_width=True):
                 with st.spinner("正在构建索引，首次需下载嵌入模型，请耐心等待…"):
                     build_index(course)
+                _invalidate_files()
                 st.rerun()
 
 
@@ -540,10 +785,9 @@ if st.session_state.current_course:
     # ── 顶栏：课程/模式信息 + 帮助 + 清空历史 ────────────────────────────────
     col_info, col_btns = st.columns([6, 2])
     with col_info:
-        c = MODE_THEME[st.session_state.current_mode]
         st.markdown(
             f"**当前课程**：{st.session_state.current_course} &nbsp;&nbsp;"
-            f'<span class="mode-pill">{c["label"]}</span>',
+            + _MODE_PILL_HTML[st.session_state.current_mode],
             unsafe_allow_html=True,
         )
     with col_btns:
@@ -567,57 +811,10 @@ if st.session_state.current_course:
     st.markdown("---")
 
     # ── 对话区模式指示条 ──────────────────────────────────────────────────────
-    mode_bar_info = {
-        "learn":    ("📖", "学习模式", "提问知识点 · 生成思维导图 · 保存笔记"),
-        "practice": ("✍️", "练习模式", "指定题型和知识点 · 提交答案后自动评分"),
-        "exam":     ("📝", "考试模式", "配置考试 → 收到试卷 → 一次性提交全部答案"),
-    }
-    icon, label, tip = mode_bar_info[st.session_state.current_mode]
-    st.markdown(
-        f'<div class="mode-bar">{icon} <span>{label}</span>'
-        f'<span style="font-weight:400;font-size:0.82rem;opacity:0.8;margin-left:8px">· {tip}</span></div>',
-        unsafe_allow_html=True,
-    )
+    st.markdown(_MODE_BAR_HTML[st.session_state.current_mode], unsafe_allow_html=True)
 
     # Display chat history
-    for msg in st.session_state.chat_history:
-        with st.chat_message(msg["role"]):
-            st.markdown(fix_latex(msg["content"]))
-            
-            # Display citations if available
-            if msg.get("citations"):
-                with st.expander(f"📑 查看引用来源（共 {len(msg['citations'])} 条）"):
-                    for i, citation in enumerate(msg["citations"]):
-                        page_str = f"  第 {citation['page']} 页" if citation.get("page") else ""
-                        score_str = f"  相关度 {citation['score']:.2f}" if citation.get("score") is not None else ""
-                        st.markdown(
-                            f"**[来源{i+1}]** `{citation['doc_id']}`{page_str}{score_str}"
-                        )
-                        preview = citation["text"][:300].replace("\n", " ").strip()
-                        if len(citation["text"]) > 300:
-                            preview += "…"
-                        st.caption(preview)
-                        if i < len(msg["citations"]) - 1:
-                            st.divider()
-            
-            # Display tool calls if available
-            if msg.get("tool_calls"):
-                with st.expander("🔧 工具调用"):
-                    for tool_call in msg["tool_calls"]:
-                        st.json(tool_call)
-
-            # Render mermaid blocks if available
-            for m_idx, mb in enumerate(msg.get("mermaid_blocks") or []):
-                render_mermaid(mb["code"], idx=abs(hash(mb["code"])) % 100000, height=520)
-                with st.expander("📄 下载 Mermaid 源码"):
-                    safe_title = re.sub(r"[^\w\-]", "_", mb.get("title", "mindmap"))
-                    st.download_button(
-                        label="⬇ 下载 .md 文件",
-                        data=f"```mermaid\n{mb['code']}\n```",
-                        file_name=f"{safe_title}.md",
-                        mime="text/markdown",
-                        key=f"dl_md_{abs(hash(mb['code'])) % 100000}_{m_idx}",
-                    )
+    _render_chat_history(st.session_state.chat_history)
 
     # Chat input
     user_input = st.chat_input("输入你的问题...")
@@ -626,7 +823,8 @@ if st.session_state.current_course:
         # Add user message to history
         st.session_state.chat_history.append({
             "role": "user",
-            "content": user_input
+            "content": user_input,
+            "content_rendered": fix_latex(user_input),
         })
         
         # Display user message
@@ -635,10 +833,14 @@ if st.session_state.current_course:
         
         # 流式输出助手回答
         # 单独收集文本，避免依赖 st.write_stream 返回类型（新版 Streamlit 返回 StreamingOutput 而非 str）
-        collected_chunks: list[str] = []
+        collected = io.StringIO()
         st.session_state._pending_citations = []  # 在流开始前初始化
 
         def _collecting_stream():
+            # 逐 token 刷新会让气泡的 markdown 反复整体重渲染：攒够约 64 字或 32ms 再输出一次
+            buf: list[str] = []
+            buf_len = 0
+            last_flush = time.monotonic()
             for chunk in stream_chat(
                 st.session_state.current_course,
                 st.session_state.current_mode,
@@ -648,21 +850,44 @@ if st.session_state.current_course:
                 if isinstance(chunk, dict) and "__citations__" in chunk:
                     st.session_state._pending_citations = chunk["__citations__"]
                     continue  # 跳过 yield，防止 st.write_stream 把 dict 渲染成乱码
-                if isinstance(chunk, str):
-                    collected_chunks.append(chunk)
-                yield chunk
+                if not isinstance(chunk, str):
+                    # 其他非文本事件按到达顺序输出：先冲掉已攒的文本
+                    if buf:
+                        yield "".join(buf)
+                        buf.clear()
+                        buf_len = 0
+                        last_flush = time.monotonic()
+                    yield chunk
+                    continue
+                collected.write(chunk)
+                buf.append(chunk)
+                buf_len += len(chunk)
+                now = time.monotonic()
+                if buf_len >= 64 or now - last_flush > 0.032:
+                    yield "".join(buf)
+                    buf.clear()
+                    buf_len = 0
+                    last_flush = now
+            if buf:
+                yield "".join(buf)
 
         with st.chat_message("assistant"):
             st.write_stream(_collecting_stream())
 
-        full_response = "".join(collected_chunks)
+        full_response = collected.getvalue()
 
         if full_response:
             # 捕获流式过程中拦截到的 citations
             citations = st.session_state.pop("_pending_citations", None) or None
             # 提取 mermaid 代码块，避免 markdown 渲染失败
             cleaned_response, mermaid_codes = extract_mermaid_blocks(full_response)
-            mermaid_blocks = [{"code": c, "title": "思维导图"} for c in mermaid_codes]
+            # 组件 id 与下载文件名在加入历史时算好，rerun 时直接复用
+            mermaid_title = "思维导图"
+            safe_title = _SAFE_TITLE_RE.sub("_", mermaid_title)
+            mermaid_blocks = [
+                {"code": c, "title": mermaid_title, "safe_title": safe_title, "id": _mm_id(c)}
+                for c in mermaid_codes
+            ]
             # 把完整回答加入对话历史（存储时转换定界符，方便后续重渲染）
             st.session_state.chat_history.append({
                 "role": "assistant",
@@ -4,7 +4,8 @@ import os
 import math
 import statistics
 import requests
-from typing import Dict, Any, List
+from contextvars import ContextVar
+from typing import Dict, Any, List, Optional
 
 
 # ── OpenAI Function Calling Schema 定义 ─────────────────────────────────────
@@ -188,8 +189,8 @@ def _extract_mermaid_code(text: str) -> str:
 class MCPTools:
     """MCP tools implementation with real backends."""
 
-    # 由 runner 在每次调用前注入上下文（如 notes_dir）
-    _context: Dict[str, Any] = {}
+    # 由 runner 按请求注入上下文（如 notes_dir）；ContextVar 隔离并发请求，互不覆盖
+    _context_var: ContextVar[Optional[Dict[str, Any]]] = ContextVar("mcp_tool_context", default=None)
 
     @staticmethod
     def calculator(expression: str) -> Dict[str, Any]:
@@ -480,7 +481,7 @@ class MCPTools:
         elif tool_name == "get_datetime":
             return MCPTools.get_datetime(kwargs.get("timezone"))
         elif tool_name == "filewriter":
-            notes_dir = MCPTools._context.get("notes_dir", "./data/notes")
+            notes_dir = (MCPTools._context_var.get() or {}).get("notes_dir", "./data/notes")
             return MCPTools.filewriter(
                 filename=kwargs.get("filename", "note.md"),
                 content=kwargs.get("content", ""),
@@ -60,24 +60,34 @@ class EmbeddingModel:
         self._batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", _default_bs))
         print(f"[Embed] 模型={model_name}  设备={self._device}  batch_size={self._batch_size}")
 
-    def embed(self, texts: List[str]) -> np.ndarray:
+    @property
+    def batch_size(self) -> int:
+        """Default encode batch size (EMBEDDING_BATCH_SIZE)."""
+        return self._batch_size
+
+    def embed(self, texts: List[str], batch_size: int = None) -> np.ndarray:
         """Generate embeddings for document chunks (no prefix)."""
         return self.model.encode(
             texts,
-            batch_size=self._batch_size,
+            batch_size=batch_size or self._batch_size,
             show_progress_bar=len(texts) > 100,
             normalize_embeddings=True,
         )
 
     def embed_query(self, query: str) -> np.ndarray:
         """Generate embedding for a query (with BGE instruction prefix if needed)."""
-        prefixed = self._query_prefix + query if self._query_prefix else query
+        return self.embed_queries([query])[0]
+
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        """一次编码多条查询（同样加 BGE 查询前缀），返回 (n, dim) 矩阵。"""
+        if self._query_prefix:
+            queries = [self._query_prefix + q for q in queries]
         return self.model.encode(
-            [prefixed],
-            batch_size=1,
+            queries,
+            batch_size=len(queries),
             show_progress_bar=False,
             normalize_embeddings=True,
-        )[0]
+        )
 
 
 # Global embedding model
@@ -176,3 +176,13 @@ class DocumentParser:
         else:
             print(f"Unsupported file type: {ext}")
             return []
+
+
+def parse_and_chunk_document(file_path: str) -> List[Dict[str, Any]]:
+    """解析单个文件并直接切块。
+
+    模块级函数，可被 ProcessPoolExecutor pickle：解析与切块在同一个工作进程内完成，
+    页面文本无需传回主进程再切块。
+    """
+    from rag.chunk import chunk_documents
+    return chunk_documents(DocumentParser.parse_document(file_path))
@@ -1,6 +1,9 @@
 """RAG retrieval with citations."""
 import os
-from typing import List, Dict, Any
+import queue
+import threading
+from concurrent.futures import Future
+from typing import List, Dict, Any, Optional, Tuple
 from rag.store_faiss import FAISSStore
 from rag.embed import get_embedding_model
 from backend.schemas import RetrievedChunk
@@ -8,35 +11,45 @@ from backend.schemas import RetrievedChunk
 
 class Retriever:
     """RAG retriever with citation generation."""
-    
+
     def __init__(self, store: FAISSStore):
         self.store = store
         self.embedding_model = get_embedding_model()
-    
+
     def retrieve(
         self,
         query: str,
         top_k: int = None
     ) -> List[RetrievedChunk]:
         """Retrieve relevant chunks for a query."""
+        return self.retrieve_batch([query], top_k)[0]
+
+    def retrieve_batch(
+        self,
+        queries: List[str],
+        top_k: int = None
+    ) -> List[List[RetrievedChunk]]:
+        """多条查询一起检索：一次 embedding 编码 + 一次 FAISS 搜索。"""
         if top_k is None:
             top_k = int(os.getenv("TOP_K_RESULTS", "3"))
-        
-        query_embedding = self.embedding_model.embed_query(query)
-        results = self.store.search(query_embedding, top_k)
-        
-        retrieved = []
-        for chunk, score in results:
-            retrieved.append(RetrievedChunk(
-                text=chunk["text"],
-                doc_id=chunk["doc_id"],
-                page=chunk.get("page"),
-                chunk_id=chunk.get("chunk_id"),
-                score=float(score)
-            ))
-        
-        return retrieved
-    
+
+        query_embeddings = self.embedding_model.embed_queries(queries)
+        batch = self.store.search_batch(query_embeddings, top_k)
+
+        return [
+            [
+                RetrievedChunk(
+                    text=chunk["text"],
+                    doc_id=chunk["doc_id"],
+                    page=chunk.get("page"),
+                    chunk_id=chunk.get("chunk_id"),
+                    score=float(score)
+                )
+                for chunk, score in results
+            ]
+            for results in batch
+        ]
+
     def format_context(self, chunks: List[RetrievedChunk]) -> str:
         """Format retrieved chunks as context for LLM."""
         context_parts = []
@@ -45,7 +58,77 @@ class Retriever:
             if chunk.page:
                 citation += f", 第{chunk.page}页"
             citation += "]"
-            
+
             context_parts.append(f"{citation}\n{chunk.text}\n")
-        
+
         return "\n".join(context_parts)
+
+
+class RetrievalBatcher:
+    """把并发请求的检索合并成批：同一 Retriever 的查询一次编码、一次 FAISS 搜索。
+
+    单个后台线程消费队列。每批先取出当前已排队的全部请求（可选再等待 window 秒），
+    处理期间新到的请求自然积攒成下一批——低负载时不增加延迟，高并发时自动成批。
+    """
+
+    def __init__(self, window: float = 0.0):
+        self.window = window
+        self._queue: "queue.Queue[Tuple[Retriever, str, Optional[int], Future]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, name="rag-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, retriever: Retriever, query: str, top_k: int = None) -> "Future[List[RetrievedChunk]]":
+        future: "Future[List[RetrievedChunk]]" = Future()
+        self._queue.put((retriever, query, top_k, future))
+        return future
+
+    def _drain(self) -> List[Tuple[Retriever, str, Optional[int], Future]]:
+        items = [self._queue.get()]
+        if self.window > 0:
+            try:
+                items.append(self._queue.get(timeout=self.window))
+            except queue.Empty:
+                pass
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    def _worker(self):
+        while True:
+            groups: Dict[int, Tuple[Retriever, List[Tuple[str, Optional[int], Future]]]] = {}
+            for retriever, query, top_k, future in self._drain():
+                if future.set_running_or_notify_cancel():
+                    groups.setdefault(id(retriever), (retriever, []))[1].append((query, top_k, future))
+            for retriever, entries in groups.values():
+                self._run_group(retriever, entries)
+
+    @staticmethod
+    def _run_group(retriever: Retriever, entries: List[Tuple[str, Optional[int], Future]]):
+        default_k = int(os.getenv("TOP_K_RESULTS", "3"))
+        ks = [k if k is not None else default_k for _, k, _ in entries]
+        try:
+            # 以最大的 top_k 统一搜索，再按各自的 top_k 截取
+            batch = retriever.retrieve_batch([q for q, _, _ in entries], max(ks))
+        except Exception as e:
+            for _, _, future in entries:
+                future.set_exception(e)
+            return
+        for (_, _, future), k, chunks in zip(entries, ks, batch):
+            future.set_result(chunks[:k])
+
+
+_retrieval_batcher = None
+_retrieval_batcher_lock = threading.Lock()
+
+
+def get_retrieval_batcher() -> RetrievalBatcher:
+    """Get or create global retrieval batcher（RETRIEVAL_BATCH_WINDOW_MS 为额外等待的合批窗口，默认 0）。"""
+    global _retrieval_batcher
+    if _retrieval_batcher is None:
+        with _retrieval_batcher_lock:
+            if _retrieval_batcher is None:
+                window_ms = float(os.getenv("RETRIEVAL_BATCH_WINDOW_MS", "0"))
+                _retrieval_batcher = RetrievalBatcher(window=window_ms / 1000)
+    return _retrieval_batcher
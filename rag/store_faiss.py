@@ -1,16 +1,69 @@
 """FAISS vector store."""
 import os
+import json
+import logging
+import time
+import uuid
 import pickle
+import hashlib
 import threading
-from typing import List, Dict, Any, Tuple
+from itertools import islice
+from typing import List, Dict, Any, Optional, Tuple
 import faiss
 import numpy as np
 from rag.embed import get_embedding_model
 
+logger = logging.getLogger(__name__)
+
 # Windows 下 FAISS C++ 的 fopen 不支持 Unicode 路径，只能 chdir 绕过。
 # 用全局锁确保并发请求不互相干扰 os.chdir。
 _faiss_chdir_lock = threading.Lock()
 
+# 加载索引时是否 mmap 只读映射（MMAP_INDEX=1/0）。mmap 后打开索引与大小无关，
+# 多个 uvicorn worker 通过页缓存共享同一份数据。Windows 下被映射的文件无法被替换，默认关闭。
+_MMAP_INDEX = os.getenv("MMAP_INDEX", "0" if os.name == "nt" else "1") == "1"
+# IO_FLAG_MMAP_IFC（IndexFlat 等也走 mmap）只有较新的 faiss 才有，旧版本退回普通 IO_FLAG_MMAP
+_MMAP_FLAGS = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+
+
+# 索引由以下文件组成；manifest 最后写入，记录本次快照各文件大小
+_INDEX_SUFFIXES = (".faiss", ".pkl", ".hashes.pkl")
+_MANIFEST_SUFFIX = ".manifest.json"
+
+
+class IndexIntegrityError(RuntimeError):
+    """索引文件缺失、不完整或与 manifest 不一致（例如写盘中途进程被杀）。"""
+
+
+def _fsync_file(path: str):
+    with open(path, "rb+") as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(path: str):
+    """rename 之后 fsync 目录，确保目录项落盘（Windows 不支持打开目录，跳过）。"""
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def chunk_hash(text: str) -> str:
+    """Content hash of a chunk's text, used to skip re-embedding on rebuild."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def file_hash(path: str) -> str:
+    """Content hash of a file, read in 1 MiB blocks."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
 
 class FAISSStore:
     """FAISS-based vector store."""
@@ -19,28 +72,53 @@ class FAISSStore:
         self.dimension = dimension
         self.index = faiss.IndexFlatL2(dimension)
         self.chunks = []
+        self.chunk_hashes: List[str] = []      # 与 chunks 一一对应
+        self.file_hashes: Dict[str, str] = {}  # doc_id -> 源文件内容哈希
+        self.read_only = False                 # mmap 加载的索引不可再 add
     
-    def add_chunks(self, chunks: List[Dict[str, Any]], embeddings: np.ndarray):
+    def add_chunks(self, chunks: List[Dict[str, Any]], embeddings: np.ndarray,
+                   hashes: Optional[List[str]] = None):
         """Add chunks and their embeddings to the store."""
+        if self.read_only:
+            raise RuntimeError("索引以 mmap 只读方式加载，不能追加向量")
         self.index.add(embeddings.astype('float32'))
         self.chunks.extend(chunks)
+        self.chunk_hashes.extend(hashes or [chunk_hash(c["text"]) for c in chunks])
+
+    def vectors(self) -> np.ndarray:
+        """Return all stored vectors (row i belongs to chunks[i])."""
+        return self.index.reconstruct_n(0, self.index.ntotal)
     
     def search(self, query_embedding: np.ndarray, top_k: int = 3) -> List[Tuple[Dict[str, Any], float]]:
         """Search for similar chunks."""
-        query_embedding = query_embedding.astype('float32').reshape(1, -1)
-        distances, indices = self.index.search(query_embedding, top_k)
-        
-        results = []
-        for i, idx in enumerate(indices[0]):
-            if idx < len(self.chunks):
-                # Convert L2 distance to similarity score (inverse)
-                score = 1.0 / (1.0 + distances[0][i])
-                results.append((self.chunks[idx], score))
+        return self.search_batch(query_embedding.reshape(1, -1), top_k)[0]
+
+    def search_batch(
+        self, query_embeddings: np.ndarray, top_k: int = 3
+    ) -> List[List[Tuple[Dict[str, Any], float]]]:
+        """多条查询一次 index.search（FAISS 内部走一次矩阵运算），逐条返回结果。"""
+        query_embeddings = np.ascontiguousarray(query_embeddings, dtype='float32')
+        distances, indices = self.index.search(query_embeddings, top_k)
         
-        return results
+        n_chunks = len(self.chunks)
+        batch = []
+        for row_dist, row_idx in zip(distances, indices):
+            results = []
+            for dist, idx in zip(row_dist, row_idx):
+                # FAISS 结果不足 top_k 时以 -1 填充
+                if 0 <= idx < n_chunks:
+                    # Convert L2 distance to similarity score (inverse)
+                    results.append((self.chunks[idx], 1.0 / (1.0 + float(dist))))
+            batch.append(results)
+        return batch
     
     def save(self, path: str):
-        """Save index and chunks to disk."""
+        """Save index and chunks to disk atomically.
+
+        各文件先写 *.tmp 并 fsync，再逐个 os.replace 到正式文件名，最后写 manifest。
+        进程在任一步被杀，磁盘上要么是旧快照，要么 manifest 与文件对不上而被 load 拒绝，
+        不会读到写了一半的文件。
+        """
         path = os.path.abspath(path)
         index_dir = os.path.dirname(path)
         filename = os.path.basename(path)
@@ -51,26 +129,103 @@ class FAISSStore:
             cwd = os.getcwd()
             try:
                 os.chdir(index_dir)
-                faiss.write_index(self.index, f"{filename}.faiss")
+                faiss.write_index(self.index, f"{filename}.faiss.tmp")
             finally:
                 os.chdir(cwd)
-        with open(f"{path}.pkl", 'wb') as f:
+        with open(f"{path}.pkl.tmp", 'wb') as f:
             pickle.dump(self.chunks, f)
-    
-    def load(self, path: str):
-        """Load index and chunks from disk."""
+        with open(f"{path}.hashes.pkl.tmp", 'wb') as f:
+            pickle.dump({"files": self.file_hashes, "chunks": self.chunk_hashes}, f)
+        for suffix in _INDEX_SUFFIXES:
+            _fsync_file(f"{path}{suffix}.tmp")
+        # 旧索引可能正被 mmap 映射，rename 替换不会影响已映射的读者
+        for suffix in _INDEX_SUFFIXES:
+            os.replace(f"{path}{suffix}.tmp", f"{path}{suffix}")
+
+        manifest = {
+            "id": uuid.uuid4().hex,
+            "created_at": time.time(),
+            "nchunks": len(self.chunks),
+            "dimension": self.dimension,
+            "chunks_digest": hashlib.blake2b(
+                "".join(self.chunk_hashes).encode("ascii"), digest_size=16
+            ).hexdigest(),
+            "sizes": {suffix: os.path.getsize(f"{path}{suffix}") for suffix in _INDEX_SUFFIXES},
+        }
+        with open(f"{path}{_MANIFEST_SUFFIX}.tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}{_MANIFEST_SUFFIX}.tmp", f"{path}{_MANIFEST_SUFFIX}")
+        _fsync_dir(index_dir)
+
+    @staticmethod
+    def _check_manifest(path: str) -> Optional[Dict[str, Any]]:
+        """校验 manifest 记录的文件大小与磁盘一致；旧版本索引没有 manifest，返回 None。"""
+        try:
+            with open(f"{path}{_MANIFEST_SUFFIX}", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            raise IndexIntegrityError(f"索引 manifest 损坏: {e}")
+        for suffix, size in manifest.get("sizes", {}).items():
+            try:
+                actual = os.path.getsize(f"{path}{suffix}")
+            except FileNotFoundError:
+                raise IndexIntegrityError(f"索引文件缺失: {os.path.basename(path)}{suffix}")
+            if actual != size:
+                raise IndexIntegrityError(
+                    f"索引文件 {os.path.basename(path)}{suffix} 与 manifest 不一致（可能写盘未完成）"
+                )
+        return manifest
+
+    def load(self, path: str, mmap: Optional[bool] = None):
+        """Load index and chunks from disk.
+
+        mmap=None 时按 MMAP_INDEX 环境变量决定是否只读映射；映射失败则回退为整体读入。
+        文件与 manifest 不一致或向量数与文本块数对不上时抛出 IndexIntegrityError。
+        """
         path = os.path.abspath(path)
         index_dir = os.path.dirname(path)
         filename = os.path.basename(path)
+        use_mmap = _MMAP_INDEX if mmap is None else mmap
+        manifest = self._check_manifest(path)
         with _faiss_chdir_lock:
             cwd = os.getcwd()
             try:
                 os.chdir(index_dir)
-                self.index = faiss.read_index(f"{filename}.faiss")
+                self.read_only = False
+                if use_mmap:
+                    try:
+                        self.index = faiss.read_index(f"{filename}.faiss", _MMAP_FLAGS)
+                        self.read_only = True
+                    except RuntimeError as e:
+                        logger.warning("[FAISS] mmap 加载失败，回退为普通加载", exc_info=e)
+                        self.index = faiss.read_index(f"{filename}.faiss")
+                else:
+                    self.index = faiss.read_index(f"{filename}.faiss")
             finally:
                 os.chdir(cwd)
         with open(f"{path}.pkl", 'rb') as f:
             self.chunks = pickle.load(f)
+        self.dimension = self.index.d
+        # 旧版本索引没有 hashes.pkl，此时按文本现算 chunk 哈希
+        try:
+            with open(f"{path}.hashes.pkl", 'rb') as f:
+                hashes = pickle.load(f)
+            self.file_hashes = hashes.get("files", {})
+            self.chunk_hashes = hashes.get("chunks", [])
+        except FileNotFoundError:
+            self.file_hashes = {}
+            self.chunk_hashes = []
+        if len(self.chunk_hashes) != len(self.chunks):
+            self.chunk_hashes = [chunk_hash(c["text"]) for c in self.chunks]
+        expected = manifest["nchunks"] if manifest else len(self.chunks)
+        if not (self.index.ntotal == len(self.chunks) == expected):
+            raise IndexIntegrityError(
+                f"索引不完整：向量 {self.index.ntotal} 个，文本块 {len(self.chunks)} 个，manifest 记录 {expected} 个"
+            )
     
     @property
     def size(self) -> int:
@@ -78,13 +233,85 @@ class FAISSStore:
         return self.index.ntotal
 
 
-def build_index(chunks: List[Dict[str, Any]]) -> FAISSStore:
-    """Build FAISS index from chunks."""
-    embedding_model = get_embedding_model()
-    texts = [chunk["text"] for chunk in chunks]
-    embeddings = embedding_model.embed(texts)
-    
-    store = FAISSStore(dimension=embeddings.shape[1])
-    store.add_chunks(chunks, embeddings)
-    
-    return store
+class IndexBuilder:
+    """增量构建 FAISSStore：chunk 可分多次 feed，凑满一个 batch 就向量化。
+
+    previous 中已有相同内容哈希的 chunk 直接复用旧向量。feed/embed_pending 可与
+    上游解析交替调用，使解析与向量化流水线重叠；最后 build(chunks) 按给定顺序组装索引。
+    feed 与 embed_pending 不是线程安全的，应由同一个调用方串行调用。
+    """
+
+    def __init__(self, previous: Optional[FAISSStore] = None, embedding_batch_size: int = None):
+        self._previous = previous
+        self._known: Dict[str, int] = {}
+        if previous is not None and previous.size:
+            self._known = {h: i for i, h in enumerate(previous.chunk_hashes)}
+        self._batch_size = embedding_batch_size
+        self._new: Dict[str, np.ndarray] = {}   # 新向量化的 hash -> 向量
+        self._pending: Dict[str, str] = {}      # 待向量化的 hash -> 文本（保持插入顺序）
+        self._embedded = 0
+        self._started: Optional[float] = None
+
+    def feed(self, chunks: List[Dict[str, Any]]):
+        """登记一批 chunk，其中既不在旧索引、也未向量化过的进入待处理队列。"""
+        for c in chunks:
+            h = chunk_hash(c["text"])
+            if h not in self._known and h not in self._new:
+                self._pending.setdefault(h, c["text"])
+
+    def embed_pending(self, final: bool = False):
+        """向量化待处理队列中所有满 batch 的 chunk；final=True 时连同不足一个 batch 的尾部。"""
+        if not self._pending:
+            return
+        embedding_model = get_embedding_model()
+        batch_size = self._batch_size or embedding_model.batch_size
+        if self._started is None:
+            self._started = time.monotonic()
+        while len(self._pending) >= batch_size or (final and self._pending):
+            batch = list(islice(self._pending.items(), batch_size))
+            vectors = embedding_model.embed([t for _, t in batch], batch_size=batch_size)
+            for (h, _), v in zip(batch, vectors):
+                self._new[h] = v
+                del self._pending[h]
+            self._embedded += len(batch)
+            rate = self._embedded / max(time.monotonic() - self._started, 1e-6)
+            logger.info("[Index] 向量化 %d 块 @ %.0f 块/分钟", self._embedded, rate * 60)
+
+    def build(self, chunks: List[Dict[str, Any]]) -> FAISSStore:
+        """按 chunks 顺序组装索引（未 feed 过的 chunk 会在这里补齐向量化）。"""
+        self.feed(chunks)
+        self.embed_pending(final=True)
+        hashes = [chunk_hash(c["text"]) for c in chunks]
+        reused = sum(1 for h in hashes if h in self._known)
+        logger.info("[Index] 复用 %d 块已有向量，新向量化 %d 块", reused, len(chunks) - reused)
+
+        if self._new:
+            dimension = len(next(iter(self._new.values())))
+        else:
+            dimension = self._previous.dimension
+        embeddings = np.empty((len(chunks), dimension), dtype='float32')
+        old_vectors = self._previous.vectors() if reused else None
+        for i, h in enumerate(hashes):
+            if h in self._known:
+                embeddings[i] = old_vectors[self._known[h]]
+            else:
+                embeddings[i] = self._new[h]
+
+        store = FAISSStore(dimension=dimension)
+        store.add_chunks(chunks, embeddings, hashes)
+        return store
+
+
+def build_index(
+    chunks: List[Dict[str, Any]],
+    embedding_batch_size: int = None,
+    previous: Optional[FAISSStore] = None,
+) -> FAISSStore:
+    """Build FAISS index from chunks.
+
+    Chunks are embedded batch by batch (embedding_batch_size, defaults to the
+    model's EMBEDDING_BATCH_SIZE) with progress logged after every batch.
+    If ``previous`` is given, chunks whose content hash already exists there
+    reuse the stored vector instead of being embedded again.
+    """
+    return IndexBuilder(previous, embedding_batch_size).build(chunks)
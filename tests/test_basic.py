@@ -82,6 +82,9 @@ def test_tool_policy():
         exam_tools = ToolPolicy.get_allowed_tools("exam")
         assert "calculator" in exam_tools
         assert "websearch" not in exam_tools  # Should be disabled in exam
+        assert ToolPolicy.is_tool_allowed("websearch", "learn")
+        assert not ToolPolicy.is_tool_allowed("websearch", "exam")
+        assert ToolPolicy.get_allowed_tools("unknown") == ()
         
         print("✅ Tool policy tests passed")
         return True
@@ -111,6 +114,96 @@ def test_mcp_tools():
         return False
 
 
+def test_extract_json_block():
+    """Test JSON extraction from LLM responses."""
+    from core.agents._utils import extract_json_block
+
+    assert extract_json_block('好的：\n```json\n{"score": 80}\n```') == {"score": 80}
+    assert extract_json_block('```\n{"a": 1}\n``` 其余文字') == {"a": 1}
+    assert extract_json_block('  {"b": [1, 2]}  ') == {"b": [1, 2]}
+    assert extract_json_block('```json\n{"c": "截断"}') == {"c": "截断"}
+    assert extract_json_block('计划如下 {"d": {"e": 1}} 完毕') == {"d": {"e": 1}}
+    print("✅ JSON extraction tests passed")
+
+
+def test_no_duplicate_routes(monkeypatch):
+    """Test that every (method, path) pair is registered only once."""
+    # 导入 backend.api 会创建 LLM 客户端，没有密钥时直接报错；路由表检查不需要真实密钥
+    monkeypatch.setenv("OPENAI_API_KEY", os.getenv("OPENAI_API_KEY") or "test-key")
+    from backend.api import app
+
+    seen = set()
+    for route in app.routes:
+        for method in getattr(route, "methods", None) or {""}:
+            key = (method, route.path)
+            assert key not in seen, f"duplicate route: {key}"
+            seen.add(key)
+    assert seen, "route table is empty"
+
+    print(f"✅ Route table OK - {len(seen)} unique routes")
+
+
+def test_no_duplicate_definitions():
+    """Test that no module redefines a top-level class/function or a method."""
+    import ast
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    duplicates = []
+    checked = 0
+    for pkg in ("backend", "core", "rag", "mcp_tools", "memory"):
+        for dirpath, _, filenames in os.walk(os.path.join(root, pkg)):
+            for fn in filenames:
+                if not fn.endswith(".py"):
+                    continue
+                path = os.path.join(dirpath, fn)
+                with open(path, encoding="utf-8") as f:
+                    tree = ast.parse(f.read(), filename=path)
+                scopes = [tree.body] + [n.body for n in ast.walk(tree) if isinstance(n, ast.ClassDef)]
+                for body in scopes:
+                    names = [n.name for n in body
+                             if isinstance(n, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef))
+                             and not any(isinstance(d, ast.Attribute) or getattr(d, "id", "") == "overload"
+                                         for d in n.decorator_list)]
+                    dupes = {n for n in names if names.count(n) > 1}
+                    if dupes:
+                        duplicates.append((os.path.relpath(path, root), sorted(dupes)))
+                checked += 1
+
+    assert checked, "no modules found"
+    assert not duplicates, duplicates
+    print(f"✅ No duplicate definitions in {checked} modules")
+
+
+def test_registry_cross_worker_cache():
+    """Test that a registry sees writes made by another worker sharing the same database."""
+    import tempfile
+    from backend.registry import WorkspaceRegistry
+    from backend.schemas import CourseWorkspace
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "workspaces.db")
+        # 两个实例模拟两个 uvicorn worker，各自持有独立的 LRU 缓存
+        worker_a = WorkspaceRegistry(db_path=db_path)
+        worker_b = WorkspaceRegistry(db_path=db_path)
+        worker_a.create(CourseWorkspace(course_name="线性代数", subject="数学"))
+        assert worker_b.get("线性代数").documents == []
+
+        worker_a.add_document("线性代数", "ch1.pdf")
+        assert worker_b.get("线性代数").documents == ["ch1.pdf"]
+        worker_a.set_documents("线性代数", ["ch2.pdf"])
+        assert [ws.documents for ws in worker_b.list_all()] == [["ch2.pdf"]]
+        worker_a.remove_document("线性代数", "ch2.pdf")
+        assert worker_b.get("线性代数").documents == []
+    print("✅ Registry cross-worker cache tests passed")
+
+
+def _with_monkeypatch(test_func):
+    """脚本方式运行时为需要 monkeypatch 夹具的测试提供一个临时实例。"""
+    import pytest
+    with pytest.MonkeyPatch.context() as mp:
+        return test_func(mp)
+
+
 def run_all_tests():
     """Run all tests."""
     print("=" * 60)
@@ -124,13 +217,22 @@ def run_all_tests():
         ("RAG Components", test_rag_components),
         ("Tool Policy", test_tool_policy),
         ("MCP Tools", test_mcp_tools),
+        ("JSON Extraction", test_extract_json_block),
+        ("Route Table", lambda: _with_monkeypatch(test_no_duplicate_routes)),
+        ("Duplicate Definitions", test_no_duplicate_definitions),
+        ("Registry Cache", test_registry_cross_worker_cache),
     ]
     
     results = []
     for name, test_func in tests:
         print(f"\nRunning: {name}")
         print("-" * 60)
-        success = test_func()
+        # 旧式测试返回 bool；assert 风格的测试返回 None，失败时抛出 AssertionError
+        try:
+            success = test_func() is not False
+        except Exception as e:
+            print(f"❌ {name} failed: {e}")
+            success = False
         results.append((name, success))
         print()
     